@@ -0,0 +1,77 @@
+"""Checks parse_act_section against the BeautifulSoup reference and times both.
+
+    python benchmarks/bench_act_section.py --pages <dir of saved html_v1/{cnr}.html pages>
+
+Without --pages a synthetic corpus shaped like the eCourts case details page is used,
+plus a few pages without an acts table (empty, comment only, ...).
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elastic_utils import parse_act_section, parse_act_section_bs4
+
+
+def synthetic_page(i):
+    filler = "".join(f"<tr><td>Hearing {j}</td><td>0{j % 9 + 1}-01-2020</td><td>Adjourned</td></tr>" for j in range(40))
+    acts = "".join(f"<tr><td>Indian Penal Code &nbsp;{k}</td><td> {300 + k}, 34 </td></tr>" for k in range(i % 4 + 1))
+    return f"""<html><head><title>Case {i}</title><script>var x = "<table>";</script></head><body>
+               <div class="case_details"><table class="case_details_table"><tr><td>CNR</td><td>MHPU01{i:06d}2020</td></tr></table></div>
+               <table class="table Acts_table" id="act_table"><tr><th>Under Act(s)</th><th>Under Section(s)</th></tr>{acts}</table>
+               <table class="history_table">{filler}</table></body></html>"""
+
+
+# pages without an acts table, including bodies lxml can not build a document from
+EDGE_PAGES = [("EMPTY", ""), ("BLANK", "  \n "), ("COMMENT", "<!-- x -->"),
+              ("XML_DECL", '<?xml version="1.0"?>'), ("NO_TABLE", "<html><body><p>Record not found</p></body></html>")]
+
+
+def load_corpus(pages):
+    if pages is None:
+        return [(f"SYN{i:04d}", synthetic_page(i)) for i in range(200)] + EDGE_PAGES
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(pages, "*.html"))):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            corpus.append((os.path.basename(path)[:-len(".html")], f.read()))
+    return corpus
+
+
+def run(parser, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for cnr, contents in corpus:
+            parser(cnr, contents)
+    return (time.perf_counter() - start) / (repeat * len(corpus))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--pages", default=None)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+
+    corpus = load_corpus(args.pages)
+    mismatched = []
+    for cnr, contents in corpus:
+        expected = parse_act_section_bs4(cnr, contents).reset_index(drop=True)
+        actual = parse_act_section(cnr, contents).reset_index(drop=True)
+        if not expected.equals(actual):
+            mismatched.append(cnr)
+    print(f"pages: {len(corpus)}, mismatched: {len(mismatched)}")
+    for cnr in mismatched[:20]:
+        print(f"  mismatch: {cnr}")
+
+    bs4_time = run(parse_act_section_bs4, corpus, args.repeat)
+    lxml_time = run(parse_act_section, corpus, args.repeat)
+    print(f"bs4 html.parser: {bs4_time * 1000:.3f} ms/page")
+    print(f"lxml xpath:      {lxml_time * 1000:.3f} ms/page")
+    print(f"speedup:         {bs4_time / lxml_time:.1f}x")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Checks get_match_matrix against thefuzz's fuzz.ratio and times both.
+
+    python benchmarks/bench_fuzzy_match.py --queries 200 --choices 500
+
+Names are synthetic, built from common Indian name parts with typos, initials,
+case changes, empty strings, None and exact copies of the query mixed in.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+from thefuzz import fuzz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elastic_utils import get_match_matrix
+
+
+FIRST = ["ramesh", "suresh", "mahesh", "anita", "sunita", "mohammed", "abdul", "lakshmi",
+         "venkatesh", "pooja", "rahul", "sanjay", "vijay", "geeta", "harpreet", "गणेश"]
+LAST = ["kumar", "sharma", "patil", "singh", "khan", "reddy", "iyer", "deshmukh", "yadav", "das"]
+
+
+def random_name(rng):
+    parts = [rng.choice(FIRST), rng.choice(LAST)]
+    if rng.random() < 0.3:
+        parts.insert(1, rng.choice(FIRST)[0])
+    name = " ".join(parts)
+    if rng.random() < 0.3:
+        i = rng.randrange(len(name))
+        name = name[:i] + rng.choice("aeiouy ") + name[i + 1:]
+    if rng.random() < 0.2:
+        name = name.upper()
+    return name
+
+
+def make_choices(rng, queries, count):
+    choices = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.03:
+            choices.append(None)
+        elif kind < 0.06:
+            choices.append("")
+        elif kind < 0.1:
+            choices.append(rng.choice(queries))
+        else:
+            choices.append(random_name(rng))
+    return choices
+
+
+def ratio_loop(queries, choices):
+    return [[fuzz.ratio(query, choice) for choice in choices] for query in queries]
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--queries", type=int, default=200)
+    arg_parser.add_argument("--choices", type=int, default=500)
+    arg_parser.add_argument("--workers", type=int, default=1)
+    arg_parser.add_argument("--seed", type=int, default=7)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    queries = [random_name(rng) for _ in range(args.queries)] + [""]
+    choices = make_choices(rng, queries, args.choices)
+
+    expected, loop_time = timed(ratio_loop, queries, choices)
+    actual, matrix_time = timed(get_match_matrix, queries, choices, args.workers)
+
+    mismatched = [(query, choice, expected[i][j], int(actual[i][j]))
+                  for i, query in enumerate(queries) for j, choice in enumerate(choices)
+                  if expected[i][j] != actual[i][j]]
+    print(f"pairs: {len(queries) * len(choices)}, mismatched: {len(mismatched)}")
+    for query, choice, want, got in mismatched[:20]:
+        print(f"  mismatch: {query!r} vs {choice!r}: fuzz.ratio {want}, get_match_matrix {got}")
+
+    print(f"fuzz.ratio loop:  {loop_time * 1000:.1f} ms")
+    print(f"get_match_matrix: {matrix_time * 1000:.1f} ms")
+    print(f"speedup:          {loop_time / matrix_time:.1f}x")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""Checks mark_cases against the iterrows loop mark_green/mark_red used before and times both.
+
+    python benchmarks/bench_mark_cases.py --cases 2000
+
+The rule tables and cases are synthetic, with the shapes the court_ipc_* tables and
+the parsed act sections come in: int, Decimal, float and text codes, acts differing
+only in case and whitespace, missing acts and sections that are not lists.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache_utils import IpcRuleIndex
+from utils import mark_cases
+
+
+ACTS = ["Indian Penal Code", "Arms Act", "Narcotic Drugs and Psychotropic Substances Act",
+        "Motor Vehicles Act", "Prohibition Act", "Information Technology Act"]
+
+
+def random_code(rng):
+    code = rng.randint(1, 511)
+    kind = rng.random()
+    if kind < 0.4:
+        return code
+    if kind < 0.6:
+        return Decimal(code)
+    if kind < 0.7:
+        return float(code)
+    if kind < 0.9:
+        return str(code)
+    return f"{code}{rng.choice('ABC')}"
+
+
+def make_rules(rng, count):
+    rules = []
+    for _ in range(count):
+        act = rng.choice(ACTS[:4])
+        if rng.random() < 0.3:
+            act = f"  {act.upper()} "
+        rules.append((act, random_code(rng)))
+    return rules
+
+
+def random_section(rng):
+    sections = []
+    for _ in range(rng.randint(1, 4)):
+        code = rng.randint(1, 511)
+        sections.append(str(code) if rng.random() < 0.8 else f"{code}{rng.choice('ABC')}")
+    return sections
+
+
+def make_cases(rng, count):
+    rows = []
+    for i in range(count):
+        act = rng.choice(ACTS)
+        kind = rng.random()
+        if kind < 0.03:
+            act = None
+        elif kind < 0.2:
+            act = f" {act.lower()}  "
+        section = random_section(rng) if rng.random() > 0.03 else np.nan
+        rows.append({"cnr": f"MHPU01{i:06d}2020", "act": act, "section": section,
+                     "case_status": None})
+    return pd.DataFrame(rows)
+
+
+def mark_cases_loop(df, report_df, case_status):
+    # the loop mark_green and mark_red ran before, on a TYPE/CODE rule frame
+    failed_cnr = []
+    for index, val in df.iterrows():
+        try:
+            if val['act'].lower().strip() in report_df['TYPE'].str.lower().str.strip().unique():
+                df_new = report_df.loc[(report_df['TYPE'].str.lower().str.strip() == val['act'].lower().strip()), :]
+                try:
+                    for ev in val["section"]:
+                        try:
+                            if int(ev) in list(df_new['CODE']):
+                                df.loc[index, "case_status"] = case_status
+                            elif ev in list(df_new['CODE']):
+                                df.loc[index, "case_status"] = case_status
+                        except:
+                            if ev in list(df_new['CODE']):
+                                df.loc[index, "case_status"] = case_status
+                except:
+                    failed_cnr.append(val['cnr'])
+        except:
+            failed_cnr.append(val['cnr'])
+    return df, failed_cnr
+
+
+def mark_loop(cases, green_rules, red_rules):
+    green_df = pd.DataFrame(green_rules, columns=['TYPE', 'CODE'])
+    red_df = pd.DataFrame(red_rules, columns=['TYPE', 'CODE'])
+    cases, green_failed = mark_cases_loop(cases, green_df, 'green')
+    cases, red_failed = mark_cases_loop(cases, red_df, 'red')
+    return cases, green_failed, red_failed
+
+
+def mark_index(cases, green_rules, red_rules):
+    cases, green_failed = mark_cases(cases, IpcRuleIndex(green_rules), 'green')
+    cases, red_failed = mark_cases(cases, IpcRuleIndex(red_rules), 'red')
+    return cases, green_failed, red_failed
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--cases", type=int, default=2000)
+    arg_parser.add_argument("--rules", type=int, default=300)
+    arg_parser.add_argument("--seed", type=int, default=7)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    green_rules = make_rules(rng, args.rules)
+    red_rules = make_rules(rng, args.rules // 3)
+    cases = make_cases(rng, args.cases)
+
+    (expected, expected_green, expected_red), loop_time = timed(mark_loop, cases.copy(), green_rules, red_rules)
+    (actual, actual_green, actual_red), index_time = timed(mark_index, cases.copy(), green_rules, red_rules)
+
+    mismatched = list(cases.loc[~expected['case_status'].fillna("").eq(actual['case_status'].fillna("")), 'cnr'])
+    failed_equal = sorted(expected_green) == sorted(actual_green) and sorted(expected_red) == sorted(actual_red)
+    print(f"cases: {len(cases)}, marked: {expected['case_status'].notna().sum()}, "
+          f"mismatched: {len(mismatched)}, failed lists equal: {failed_equal}")
+    for cnr in mismatched[:20]:
+        print(f"  mismatch: {cnr}")
+
+    print(f"iterrows loop: {loop_time * 1000:.1f} ms")
+    print(f"rule index:    {index_time * 1000:.1f} ms")
+    print(f"speedup:       {loop_time / index_time:.1f}x")
+    return 1 if mismatched or not failed_equal else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""Checks char_overlap and token_overlap against the row-wise lambdas that computed
+in_same_district, in_same_state and father_in_name before, and times both.
+
+    python benchmarks/bench_overlap.py --rows 5000
+
+Inputs are synthetic place and person names with case changes, padding, repeated
+spaces, regex metacharacters, non-ascii text and empty strings mixed in.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from elastic_utils import char_overlap, token_overlap
+
+
+PLACES = ["pune", "mumbai suburban", "thane", "nagpur", "bengaluru urban", "jaipur", "lucknow",
+          "mysuru", "dakshina kannada", "north 24 parganas", "ठाणे", "st. thomas (mount)", "a+b*c?", ""]
+NAMES = ["ramesh kumar", "suresh  patil", "mohammed abdul khan", "lakshmi", "anita s. iyer",
+         "vijay singh", "raj-kumar", "गणेश यादव", "k (r) das", ""]
+
+
+def vary(rng, value):
+    kind = rng.random()
+    if kind < 0.2:
+        value = value.upper()
+    elif kind < 0.3:
+        value = f"  {value} "
+    elif kind < 0.35:
+        value = value.replace(" ", "  ")
+    return value
+
+
+def make_frame(rng, rows):
+    return pd.DataFrame({"case_district": [vary(rng, rng.choice(PLACES)) for _ in range(rows)],
+                         "case_state": [vary(rng, rng.choice(PLACES)) for _ in range(rows)],
+                         "name": [vary(rng, rng.choice(NAMES)) for _ in range(rows)]})
+
+
+def overlap_lambdas(df, district, state, father_name):
+    # the apply calls parse_elastic_result ran before
+    df = df.copy()
+    df['input_district'] = district
+    df['input_state'] = state
+    df['input_father_name'] = father_name
+    in_same_district = df.apply(lambda x: 1 if len(set(x['input_district'].lower().strip()).intersection(
+        x['case_district'].lower().strip())) > 0 else 0, axis=1)
+    in_same_state = df.apply(lambda x: 1 if len(set(x['input_state'].lower().strip()).intersection(
+        x['case_state'].lower().strip())) > 0 else 0, axis=1)
+    father_in_name = df.apply(lambda x:
+        1 if len(set(x['input_father_name'].lower().split(" ")).intersection(x['name'].lower().split(" "))) > 0 else 0, axis=1)
+    return in_same_district, in_same_state, father_in_name
+
+
+def overlap_vectorized(df, district, state, father_name):
+    return (char_overlap(df['case_district'], district),
+            char_overlap(df['case_state'], state),
+            token_overlap(df['name'], father_name))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--rows", type=int, default=5000)
+    arg_parser.add_argument("--inputs", type=int, default=20)
+    arg_parser.add_argument("--seed", type=int, default=7)
+    args = arg_parser.parse_args()
+
+    rng = random.Random(args.seed)
+    df = make_frame(rng, args.rows)
+    inputs = [(vary(rng, rng.choice(PLACES)), vary(rng, rng.choice(PLACES)), vary(rng, rng.choice(NAMES)))
+              for _ in range(args.inputs)]
+
+    mismatched = []
+    lambda_time = vectorized_time = 0
+    for district, state, father_name in inputs:
+        start = time.perf_counter()
+        expected = overlap_lambdas(df, district, state, father_name)
+        lambda_time += time.perf_counter() - start
+        start = time.perf_counter()
+        actual = overlap_vectorized(df, district, state, father_name)
+        vectorized_time += time.perf_counter() - start
+        for column, want, got in zip(["in_same_district", "in_same_state", "father_in_name"], expected, actual):
+            rows = df.index[want.values != got.reindex(df.index).values]
+            mismatched.extend((column, district, state, father_name, row) for row in rows)
+
+    print(f"inputs: {len(inputs)}, rows: {len(df)}, mismatched: {len(mismatched)}")
+    for column, district, state, father_name, row in mismatched[:20]:
+        print(f"  mismatch: {column} for ({district!r}, {state!r}, {father_name!r}) on {df.loc[row].tolist()}")
+
+    print(f"row lambdas: {lambda_time * 1000 / len(inputs):.1f} ms/case")
+    print(f"vectorized:  {vectorized_time * 1000 / len(inputs):.1f} ms/case")
+    print(f"speedup:     {lambda_time / vectorized_time:.1f}x")
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
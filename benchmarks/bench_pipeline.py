@@ -0,0 +1,482 @@
+"""Replays a synthetic case corpus through the worker against local stand-ins and reports throughput.
+
+    python benchmarks/bench_pipeline.py --db-string postgresql://postgres@localhost/crc_bench --cases 200
+
+Elasticsearch (_search, _msearch and point in time paging), S3 (case details pages,
+order copy listings and presigned urls) and the notify api are served by one local
+aiohttp server. Postgres has to be a scratch database, the fixture tables are dropped
+and recreated on every run. Worker settings are read from the environment as usual,
+e.g. WORKER_CONCURRENCY=10 ES_USE_MSEARCH=true python benchmarks/bench_pipeline.py ...
+
+pincode, court_data, court_ipc_green and court_ipc_red keep the names the worker
+reads, so the run stops when they already hold rows unless --recreate-fixture is
+given, e.g. for a rerun against the same scratch database.
+
+--recorded replays saved _search responses (a json list of response bodies) round
+robin instead of the synthetic hits.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_TABLES = {
+    "cnr_request_queue": "bench_cnr_request_queue",
+    "cnr_request_status": "bench_cnr_request_status",
+    "cnr_request_report": "bench_cnr_request_report",
+    "cnr_request_result": "bench_cnr_request_result",
+    "cnr_fir_idx": "bench_cnr_fir_idx",
+    "cnr_fir_pincode": "bench_cnr_fir_pincode",
+    "court_pincode": "bench_court_pincode",
+    "NOTIFY_OUTBOX_TABLE": "bench_notify_outbox",
+}
+# read by the worker under these names, so they can not be given bench_ names
+SHARED_TABLES = ["pincode", "court_data", "court_ipc_green", "court_ipc_red"]
+INDEX_NAME = "bench_cases"
+BUCKET = "bench-bucket"
+STATE = "maharashtra"
+DISTRICTS = ["pune", "satara", "solapur", "sangli", "kolhapur"]
+FIRST_NAMES = ["ramesh", "suresh", "mahesh", "ganesh", "dinesh", "rajesh", "mukesh", "prakash", "santosh", "vijay"]
+LAST_NAMES = ["patil", "jadhav", "shinde", "pawar", "kale", "more", "deshmukh", "kulkarni", "gaikwad", "chavan"]
+GREEN_ACTS = [("Indian Penal Code", ["279", "304A", "337", "338"]),
+              ("Motor Vehicles Act", ["184", "185"]),
+              ("Negotiable Instruments Act", ["138"]),
+              ("Maharashtra Police Act", ["110", "117"])]
+RED_ACTS = [("Indian Penal Code", ["302", "34"]),
+            ("Indian Penal Code", ["420", "406"])]
+GREEN_RULES = [("indian penal code", 279), ("indian penal code", 337), ("motor vehicles act", 184),
+               ("negotiable instruments act", 138)]
+RED_RULES = [("indian penal code", 302), ("indian penal code", 420), ("indian penal code", 406)]
+
+
+def stable_hash(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+class Corpus:
+    # the synthetic world shared by the fixture tables and the stand-in servers
+
+    def __init__(self, cases, documents, hits, pincodes, seed):
+        rng = random.Random(seed)
+        self.hits = hits
+        self.pincodes = [(411001 + i, DISTRICTS[i % len(DISTRICTS)], STATE,
+                          18.5 + rng.uniform(-0.3, 0.3), 73.8 + rng.uniform(-0.3, 0.3)) for i in range(pincodes)]
+        self.courts = [f"MHPU{i:02d}" for i in range(1, 21)]
+        self.court_locations = [(court, 18.5 + rng.uniform(-0.3, 0.3), 73.8 + rng.uniform(-0.3, 0.3)) for court in self.courts]
+        self.cnrs = [f"{self.courts[i % len(self.courts)]}{i:06d}2020" for i in range(documents)]
+        self.cases = []
+        for i in range(cases):
+            pincode, district, state, _, _ = self.pincodes[i % len(self.pincodes)]
+            name = f"{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+            father_name = f"{rng.choice(FIRST_NAMES)} {name.split(' ')[-1]}"
+            self.cases.append({"idx": f"bench-{i:06d}", "emp_id": f"emp-{i:06d}", "name": name,
+                               "father_name": father_name, "pincode": str(pincode),
+                               "state": state, "district": district})
+        self.by_name = {case["name"]: case for case in self.cases}
+
+    def get_documents(self, name):
+        # the same documents come back for every query of a case, so the cascade overlaps
+        case = self.by_name.get(name)
+        seed = stable_hash(name)
+        documents = []
+        for j in range(self.hits):
+            cnr = self.cnrs[(seed + j * 7919) % len(self.cnrs)]
+            exact = j % 3 == 0
+            documents.append({
+                "_id": cnr,
+                "_source": {
+                    "cnr": cnr,
+                    "name": name if exact else name[:-2] + "ar",
+                    "party_type": "petitioner" if j % 7 == 0 else "respondent",
+                    "relative": case["father_name"] if case is not None else "",
+                    "relation_type": "father",
+                    "case_location": case["district"] if case is not None else "",
+                    "case_state": STATE,
+                    "case_district": case["district"] if case is not None else "",
+                    "case_court": f"court {cnr[:6]}",
+                    "case_stage": "disposed",
+                    "fir_police_station": f"police station {cnr[4:6]}",
+                    "act_section": "",
+                    "order_exists": j % 2 == 0,
+                }
+            })
+        return documents
+
+    def get_page(self, cnr):
+        # one document in a hundred carries a red section, so most cases come back green
+        seed = stable_hash(cnr)
+        acts = RED_ACTS[seed % len(RED_ACTS)] if seed % 100 == 0 else GREEN_ACTS[seed % len(GREEN_ACTS)]
+        rows = f"<tr><td>{acts[0]}</td><td> {', '.join(acts[1])} </td></tr>"
+        filler = "".join(f"<tr><td>Hearing {j}</td><td>0{j % 9 + 1}-01-2020</td><td>Adjourned</td></tr>" for j in range(40))
+        return f"""<html><head><title>{cnr}</title></head><body>
+                   <table class="case_details_table"><tr><td>CNR</td><td>{cnr}</td></tr></table>
+                   <table class="table Acts_table" id="act_table"><tr><th>Under Act(s)</th><th>Under Section(s)</th></tr>{rows}</table>
+                   <table class="history_table">{filler}</table></body></html>"""
+
+
+def find_match_query(query, field):
+    # the searched text of the first match clause on `field` anywhere in the query
+    if isinstance(query, dict):
+        if "match" in query and field in query["match"]:
+            value = query["match"][field]
+            return value["query"] if isinstance(value, dict) else value
+        values = query.values()
+    elif isinstance(query, list):
+        values = query
+    else:
+        return None
+    for value in values:
+        found = find_match_query(value, field)
+        if found is not None:
+            return found
+    return None
+
+
+class StandIns:
+    # elasticsearch, s3 and notify on one local aiohttp server
+
+    def __init__(self, corpus, recorded=None, es_latency=0.0, s3_latency=0.0, notify_latency=0.0):
+        self.corpus = corpus
+        self.recorded = recorded
+        self.es_latency = es_latency
+        self.s3_latency = s3_latency
+        self.notify_latency = notify_latency
+        self.counters = defaultdict(int)
+        self.pits = {}
+        self.runner = None
+        self.port = None
+
+    def es_response(self, body):
+        self.counters["es_searches"] += 1
+        if self.recorded:
+            return self.recorded[self.counters["es_searches"] % len(self.recorded)]
+        size = body.get("size", 10)
+        documents = self.corpus.get_documents(find_match_query(body.get("query"), "name"))
+        start = 0
+        if "search_after" in body:
+            start = body["search_after"][1] + 1
+        hits = []
+        for position, document in enumerate(documents[start:start + size], start):
+            hit = {"_index": INDEX_NAME, "_score": 10.0 - position * 0.01, **document}
+            if "pit" in body:
+                hit["sort"] = [hit["_score"], position]
+            hits.append(hit)
+        response = {"took": 1, "timed_out": False,
+                    "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                    "hits": {"total": {"value": len(documents), "relation": "eq"}, "max_score": 10.0, "hits": hits}}
+        if "pit" in body:
+            response["pit_id"] = body["pit"]["id"]
+        return response
+
+    def es_json(self, payload):
+        return web.json_response(payload, headers={"X-Elastic-Product": "Elasticsearch"})
+
+    async def search(self, request):
+        await asyncio.sleep(self.es_latency)
+        return self.es_json(self.es_response(await request.json()))
+
+    async def msearch(self, request):
+        await asyncio.sleep(self.es_latency)
+        lines = [json.loads(line) for line in (await request.text()).splitlines() if line.strip()]
+        responses = [{**self.es_response(body), "status": 200} for body in lines[1::2]]
+        return self.es_json({"took": 1, "responses": responses})
+
+    async def open_pit(self, request):
+        pit_id = f"pit-{len(self.pits)}"
+        self.pits[pit_id] = True
+        return self.es_json({"id": pit_id})
+
+    async def close_pit(self, request):
+        body = await request.json()
+        self.pits.pop(body.get("id"), None)
+        return self.es_json({"succeeded": True, "num_freed": 1})
+
+    async def es_info(self, request):
+        return self.es_json({"version": {"number": "8.7.0"}, "tagline": "You Know, for Search"})
+
+    async def s3_list(self, request):
+        await asyncio.sleep(self.s3_latency)
+        self.counters["s3_lists"] += 1
+        prefix = request.query.get("prefix", "")
+        cnr = prefix[len("order_copy/"):]
+        contents = ""
+        if cnr and stable_hash(cnr) % 2 == 0:
+            contents = f"""<Contents><Key>{prefix}/order_1.pdf</Key><LastModified>2020-01-01T00:00:00.000Z</LastModified>
+                           <ETag>"{stable_hash(cnr)}"</ETag><Size>1024</Size><StorageClass>STANDARD</StorageClass></Contents>"""
+        body = f"""<?xml version="1.0" encoding="UTF-8"?>
+                   <ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{BUCKET}</Name>
+                   <Prefix>{prefix}</Prefix><KeyCount>{1 if contents else 0}</KeyCount><MaxKeys>1000</MaxKeys>
+                   <IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"""
+        return web.Response(text=body, content_type="application/xml")
+
+    async def s3_html(self, request):
+        await asyncio.sleep(self.s3_latency)
+        self.counters["s3_pages"] += 1
+        cnr = request.match_info["cnr"]
+        etag = f'"{stable_hash(cnr)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=self.corpus.get_page(cnr), content_type="text/html", headers={"ETag": etag})
+
+    async def notify(self, request):
+        await asyncio.sleep(self.notify_latency)
+        body = await request.json()
+        self.counters["notified"] += len(body["ref_ids"]) if "ref_ids" in body else 1
+        return web.json_response({"status": "ok"})
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/notify", self.notify)
+        app.router.add_get(f"/{BUCKET}", self.s3_list)
+        app.router.add_get(f"/{BUCKET}/html_v1/{{cnr}}.html", self.s3_html)
+        app.router.add_post("/_msearch", self.msearch)
+        app.router.add_post(f"/{INDEX_NAME}/_pit", self.open_pit)
+        app.router.add_delete("/_pit", self.close_pit)
+        app.router.add_post("/_search", self.search)
+        app.router.add_post(f"/{INDEX_NAME}/_search", self.search)
+        app.router.add_get("/", self.es_info)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{self.port}"
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def configure_env(db_string, base_url, cache_dir):
+    # explicit settings win over a .env file, load_dotenv never overrides them
+    os.environ["DB_STRING"] = db_string
+    os.environ["ES_HOSTS"] = base_url
+    os.environ["S3_ENDPOINT_URL"] = base_url
+    os.environ["notify_url"] = f"{base_url}/notify"
+    os.environ["INDEX_NAME"] = INDEX_NAME
+    os.environ["AWS_bucket_name"] = BUCKET
+    os.environ["AWS_ACCESS_KEY_ID"] = "bench"
+    os.environ["AWS_SECRET_KEY"] = "bench"
+    os.environ["notify_token"] = "bench"
+    os.environ["API_ID"] = ""
+    for name, table in BENCH_TABLES.items():
+        os.environ[name] = table
+    os.environ.setdefault("HTML_CACHE_DIR", cache_dir)
+    os.environ.setdefault("POLL_INTERVAL", "0.5")
+    os.environ.setdefault("NOTIFY_POLL_INTERVAL", "0.5")
+    os.environ.setdefault("NOTIFY_OUTBOX", "true")
+
+
+def check_shared_tables(env):
+    # the reference tables keep their production names, refuse to drop them while they hold rows
+    from sqlalchemy import text
+    from utils import get_engine
+    populated = []
+    with get_engine(env).connect() as connect:
+        for table in SHARED_TABLES:
+            if connect.execute(text(f"select to_regclass('{table}')")).scalar() is None:
+                continue
+            if connect.execute(text(f"select exists (select 1 from {table})")).scalar():
+                populated.append(table)
+    if populated:
+        raise SystemExit(f"{', '.join(populated)} already hold rows, point --db-string at a scratch database "
+                         f"or pass --recreate-fixture to drop them")
+
+
+def create_fixture(env, corpus):
+    from sqlalchemy import text
+    from utils import get_engine
+    tables = BENCH_TABLES
+    statements = [
+        f"""drop table if exists {", ".join(SHARED_TABLES)}, {", ".join(tables.values())}""",
+        "create table pincode (pincode integer, district text, state text, latitude double precision, longitude double precision)",
+        "create table court_data (court_name text, state_code_num integer, state text, district text)",
+        "create table court_ipc_green (type text, code integer)",
+        "create table court_ipc_red (type text, code integer)",
+        f"create table {tables['court_pincode']} (cnr_part text, latitude double precision, longitude double precision)",
+        f"create table {tables['cnr_fir_idx']} (cnr text, idx_list text[])",
+        f"create table {tables['cnr_fir_pincode']} (idx integer, latitude double precision, longitude double precision)",
+        f"""create table {tables['cnr_request_queue']} (idx text, emp_id text, initiated_on timestamp, name text, pincode text,
+                                                        dob text, father_name text, state text, district text, full_address text)""",
+        f"create table {tables['cnr_request_status']} (idx text, emp_id text, status text)",
+        f"create table {tables['cnr_request_result']} (idx text primary key, result jsonb)",
+        f"""create table {tables['cnr_request_report']} (idx text primary key, emp_id text, initiated_on timestamp,
+                                                         completed_on timestamp, case_status text, status_code integer, report jsonb)""",
+    ]
+    rng = random.Random(0)
+    inserts = [
+        ("insert into pincode values (:pincode, :district, :state, :latitude, :longitude)",
+         [dict(zip(["pincode", "district", "state", "latitude", "longitude"], row)) for row in corpus.pincodes]),
+        ("insert into court_data values (:court_name, 27, :state, :district)",
+         [{"court_name": f"{district} court {i}", "state": STATE, "district": district} for district in DISTRICTS for i in range(3)]),
+        ("insert into court_ipc_green values (:type, :code)", [{"type": t, "code": c} for t, c in GREEN_RULES]),
+        ("insert into court_ipc_red values (:type, :code)", [{"type": t, "code": c} for t, c in RED_RULES]),
+        (f"insert into {tables['court_pincode']} values (:cnr_part, :latitude, :longitude)",
+         [{"cnr_part": c, "latitude": lat, "longitude": lon} for c, lat, lon in corpus.court_locations]),
+        (f"insert into {tables['cnr_fir_idx']} values (:cnr, :idx_list)",
+         [{"cnr": cnr, "idx_list": [str(i * 2), str(i * 2 + 1)]} for i, cnr in enumerate(corpus.cnrs)]),
+        (f"insert into {tables['cnr_fir_pincode']} values (:idx, :latitude, :longitude)",
+         [{"idx": i, "latitude": 18.5 + rng.uniform(-0.3, 0.3), "longitude": 73.8 + rng.uniform(-0.3, 0.3)}
+          for i in range(len(corpus.cnrs) * 2)]),
+        (f"""insert into {tables['cnr_request_queue']} values (:idx, :emp_id, now(), :name, :pincode, '1990-01-01',
+                                                              :father_name, :state, :district, 'bench address')""",
+         corpus.cases),
+        (f"insert into {tables['cnr_request_status']} values (:idx, :emp_id, 'in_progress')",
+         [{"idx": case["idx"], "emp_id": case["emp_id"]} for case in corpus.cases]),
+    ]
+    with get_engine(env).connect() as connect:
+        for statement in statements:
+            connect.execute(text(statement))
+        for statement, rows in inserts:
+            connect.execute(text(statement), rows)
+        connect.commit()
+
+
+class SampleHistogram:
+    # stands in for the prometheus histograms and keeps every observation
+
+    def __init__(self, samples, label="case"):
+        self.samples = samples
+        self.label = label
+
+    def labels(self, label):
+        return SampleHistogram(self.samples, label)
+
+    def observe(self, value):
+        self.samples[self.label].append(value)
+
+
+async def count_finished(env):
+    from utils import fetch_rows
+    rows = await fetch_rows(env, f"""select count(*) from {env['cnr_request_status']}
+                                     where status in ('completed', 'failed')""")
+    return rows[0][0]
+
+
+async def run(args, corpus, recorded):
+    stand_ins = StandIns(corpus, recorded, args.es_latency_ms / 1000, args.s3_latency_ms / 1000, args.notify_latency_ms / 1000)
+    base_url = await stand_ins.start()
+    configure_env(args.db_string, base_url, tempfile.mkdtemp(prefix="crc_bench_html_"))
+
+    import metrics_utils
+    import process_cases
+    from utils import get_env, run_blocking, refresh_reference_data, fetch_rows
+    samples = defaultdict(list)
+    metrics_utils.stage_seconds = SampleHistogram(samples)
+    metrics_utils.case_seconds = SampleHistogram(samples)
+
+    env = get_env()
+    if not args.recreate_fixture:
+        check_shared_tables(env)
+    create_fixture(env, corpus)
+    await process_cases.install_worker_tables(env)
+    await run_blocking(env, refresh_reference_data, env)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    started = time.perf_counter()
+    worker = asyncio.create_task(process_cases.run_worker())
+    finished = 0
+    while finished < len(corpus.cases):
+        if worker.done():
+            worker.result()
+        await asyncio.sleep(0.1)
+        finished = await count_finished(env)
+        if time.perf_counter() - started > args.timeout:
+            print(f"timed out after {args.timeout}s with {finished} of {len(corpus.cases)} cases finished")
+            break
+    elapsed = time.perf_counter() - started
+    # give the outbox a moment to drain before stopping the dispatcher
+    deadline = time.perf_counter() + 5
+    while env['notify_outbox'] and stand_ins.counters["notified"] < finished and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+    traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    worker.cancel()
+    await asyncio.gather(worker, return_exceptions=True)
+    statuses = await fetch_rows(env, f"""select status_code, count(*) from {env['cnr_request_report']}
+                                         group by status_code order by status_code""")
+    failed = await fetch_rows(env, f"select count(*) from {env['cnr_request_status']} where status = 'failed'")
+    await process_cases.shutdown()
+    await stand_ins.stop()
+
+    report = {
+        "cases": len(corpus.cases),
+        "finished": finished,
+        "elapsed_seconds": elapsed,
+        "cases_per_second": finished / elapsed if elapsed > 0 else 0,
+        "status_codes": {str(code): count for code, count in statuses},
+        "failed": failed[0][0],
+        "notified": stand_ins.counters["notified"],
+        "stand_in_calls": dict(stand_ins.counters),
+        "stages": {stage: {"count": len(values),
+                           "p50_ms": float(np.percentile(values, 50) * 1000),
+                           "p95_ms": float(np.percentile(values, 95) * 1000),
+                           "p99_ms": float(np.percentile(values, 99) * 1000)}
+                   for stage, values in sorted(samples.items())},
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_traced_mb": traced_peak / (1024 * 1024) if traced_peak is not None else None,
+    }
+    return report
+
+
+def print_report(report):
+    print(f"cases: {report['finished']}/{report['cases']} in {report['elapsed_seconds']:.2f}s, "
+          f"{report['cases_per_second']:.2f} cases/sec")
+    print(f"status codes: {report['status_codes']}, failed: {report['failed']}, notified: {report['notified']}")
+    print(f"stand-in calls: {report['stand_in_calls']}")
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<16}{stats['count']:>8}{stats['p50_ms']:>12.2f}{stats['p95_ms']:>12.2f}{stats['p99_ms']:>12.2f}")
+    print(f"peak rss: {report['peak_rss_mb']:.1f} MB")
+    if report["peak_traced_mb"] is not None:
+        print(f"peak traced python memory: {report['peak_traced_mb']:.1f} MB")
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--db-string", required=True, help="scratch postgres database, fixture tables are recreated")
+    arg_parser.add_argument("--cases", type=int, default=200)
+    arg_parser.add_argument("--documents", type=int, default=5000)
+    arg_parser.add_argument("--hits", type=int, default=40, help="documents returned per case by the fake elasticsearch")
+    arg_parser.add_argument("--pincodes", type=int, default=50)
+    arg_parser.add_argument("--seed", type=int, default=1)
+    arg_parser.add_argument("--recorded", default=None, help="json list of recorded _search responses")
+    arg_parser.add_argument("--es-latency-ms", type=float, default=20)
+    arg_parser.add_argument("--s3-latency-ms", type=float, default=10)
+    arg_parser.add_argument("--notify-latency-ms", type=float, default=20)
+    arg_parser.add_argument("--timeout", type=float, default=600)
+    arg_parser.add_argument("--tracemalloc", action="store_true", help="also trace python allocations, slows the run down")
+    arg_parser.add_argument("--output", default=None, help="write the report as json, e.g. to compare runs")
+    arg_parser.add_argument("--recreate-fixture", action="store_true",
+                            help="drop pincode, court_data and court_ipc_* even when they hold rows")
+    args = arg_parser.parse_args()
+
+    recorded = None
+    if args.recorded:
+        with open(args.recorded) as f:
+            recorded = json.load(f)
+    corpus = Corpus(args.cases, args.documents, args.hits, args.pincodes, args.seed)
+    report = asyncio.run(run(args, corpus, recorded))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0 if report["finished"] == report["cases"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,436 @@
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from urllib.parse import unquote_plus
+from metrics_utils import register_cache
+
+
+class HtmlCache:
+    # two level cache for the case details html keyed by cnr, an in-memory LRU
+    # in front of a size capped on-disk store. Entries younger than the ttl are
+    # served as is, older ones are revalidated against their S3 ETag. The directory
+    # may be shared by several workers, so the disk index is rebuilt from it every
+    # scan_interval seconds and the cap is enforced on what all of them wrote
+
+    def __init__(self, cache_dir, memory_items, disk_bytes, ttl, scan_interval=60):
+        self.cache_dir = cache_dir
+        self.memory_items = memory_items
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self.scan_interval = scan_interval
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.scanned_at = 0
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "revalidated": 0, "evictions": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.load_disk_index()
+
+    def load_disk_index(self):
+        # oldest first, so the front of the index is the next eviction candidate
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".html"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # evicted by another worker while scanning
+                    continue
+                entries.append((stat.st_mtime, entry.name[:-len(".html")], stat.st_size))
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        for _, cnr, size in sorted(entries):
+            self.disk[cnr] = size
+            self.disk_size += size
+        self.scanned_at = time.time()
+
+    def html_path(self, cnr):
+        return os.path.join(self.cache_dir, f"{cnr}.html")
+
+    def meta_path(self, cnr):
+        return os.path.join(self.cache_dir, f"{cnr}.json")
+
+    def get(self, cnr):
+        # returns (contents, etag, is_fresh) or None
+        with self.lock:
+            entry = self.memory.get(cnr)
+            if entry is not None:
+                self.memory.move_to_end(cnr)
+                self.counters["memory_hits"] += 1
+            elif cnr in self.disk:
+                entry = self.read_disk(cnr)
+                if entry is not None:
+                    self.counters["disk_hits"] += 1
+                    self.put_memory(cnr, entry)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+        contents, etag, fetched_at = entry
+        return contents, etag, time.time() - fetched_at < self.ttl
+
+    def put(self, cnr, contents, etag):
+        entry = (contents, etag, time.time())
+        with self.lock:
+            self.put_memory(cnr, entry)
+            if self.cache_dir:
+                self.write_disk(cnr, entry)
+
+    def revalidated(self, cnr):
+        # the object did not change on S3, restart its ttl
+        with self.lock:
+            self.counters["revalidated"] += 1
+            entry = self.memory.get(cnr)
+            if entry is not None:
+                contents, etag, _ = entry
+                entry = (contents, etag, time.time())
+                self.put_memory(cnr, entry)
+                if self.cache_dir:
+                    self.write_disk(cnr, entry)
+
+    def put_memory(self, cnr, entry):
+        self.memory[cnr] = entry
+        self.memory.move_to_end(cnr)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def read_disk(self, cnr):
+        try:
+            with open(self.html_path(cnr), encoding="utf-8") as f:
+                contents = f.read()
+            with open(self.meta_path(cnr)) as f:
+                meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info(f"Dropping unreadable html cache entry for {cnr} {e}")
+            self.remove_disk(cnr)
+            return None
+        self.disk.move_to_end(cnr)
+        return contents, meta.get("etag"), meta.get("fetched_at", 0)
+
+    def write_disk(self, cnr, entry):
+        contents, etag, fetched_at = entry
+        try:
+            with open(self.html_path(cnr), "w", encoding="utf-8") as f:
+                f.write(contents)
+            with open(self.meta_path(cnr), "w") as f:
+                json.dump({"etag": etag, "fetched_at": fetched_at}, f)
+        except OSError as e:
+            logging.info(f"Unable to write html cache entry for {cnr} {e}")
+            return
+        self.disk_size -= self.disk.pop(cnr, 0)
+        size = os.path.getsize(self.html_path(cnr))
+        self.disk[cnr] = size
+        self.disk_size += size
+        if time.time() - self.scanned_at >= self.scan_interval:
+            # picks up the entries other workers wrote, and drops the ones they evicted
+            self.load_disk_index()
+        while self.disk_size > self.disk_bytes and len(self.disk) > 1:
+            oldest = next(iter(self.disk))
+            self.remove_disk(oldest)
+            self.counters["evictions"] += 1
+
+    def remove_disk(self, cnr):
+        self.disk_size -= self.disk.pop(cnr, 0)
+        for path in (self.html_path(cnr), self.meta_path(cnr)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def sizes(self):
+        with self.lock:
+            return {"memory_items": len(self.memory),
+                    "disk_items": len(self.disk),
+                    "disk_bytes": self.disk_size}
+
+
+_html_cache = None
+
+def get_html_cache(env):
+    global _html_cache
+    if _html_cache is None and env['html_cache_enabled']:
+        _html_cache = HtmlCache(env['html_cache_dir'],
+                                env['html_cache_memory_items'],
+                                env['html_cache_disk_mb'] * 1024 * 1024,
+                                env['html_cache_ttl'],
+                                env['html_cache_scan_interval'])
+        register_cache("html", _html_cache)
+    return _html_cache
+
+
+class OrderCopyIndex:
+    # sorted in-memory listing of the order copy keys, a bisect on it gives the same
+    # first key a list_objects_v2 prefix call would return without the network call
+
+    def __init__(self, prefix="order_copy/"):
+        self.prefix = prefix
+        self.keys = None
+        self.built_at = None
+        self.counters = {"hits": 0, "misses": 0}
+
+    def refresh(self, s3_client, bucket_name, inventory_manifest=None):
+        if inventory_manifest:
+            keys = self.keys_from_inventory(s3_client, bucket_name, inventory_manifest)
+        else:
+            keys = self.keys_from_listing(s3_client, bucket_name)
+        keys.sort()
+        # swap in one go so lookups never see a half built index
+        self.keys = keys
+        self.built_at = time.time()
+        logging.info(f"Order copy index built with {len(keys)} keys")
+
+    def keys_from_listing(self, s3_client, bucket_name):
+        keys = []
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=self.prefix):
+            keys.extend(obj['Key'] for obj in page.get("Contents", []))
+        return keys
+
+    def keys_from_inventory(self, s3_client, bucket_name, inventory_manifest):
+        # s3 inventory: manifest.json points at gzipped csv files with url encoded keys
+        manifest_bucket, manifest_key = self.split_s3_uri(inventory_manifest)
+        manifest = json.loads(s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)['Body'].read())
+        schema = [c.strip() for c in manifest['fileSchema'].split(",")]
+        key_col = schema.index("Key")
+        bucket_col = schema.index("Bucket") if "Bucket" in schema else None
+        keys = []
+        for inventory_file in manifest['files']:
+            body = s3_client.get_object(Bucket=manifest_bucket, Key=inventory_file['key'])['Body'].read()
+            reader = csv.reader(io.StringIO(gzip.decompress(body).decode("utf-8")))
+            for row in reader:
+                if bucket_col is not None and row[bucket_col] != bucket_name:
+                    continue
+                key = unquote_plus(row[key_col])
+                if key.startswith(self.prefix):
+                    keys.append(key)
+        return keys
+
+    def sizes(self):
+        keys = self.keys
+        return {"keys": 0 if keys is None else len(keys),
+                "age_seconds": 0 if self.built_at is None else time.time() - self.built_at}
+
+    @staticmethod
+    def split_s3_uri(uri):
+        bucket, _, key = uri[len("s3://"):].partition("/")
+        return bucket, key
+
+    def is_current(self, max_age=None):
+        # built, and rebuilt within max_age seconds when one is given
+        if self.keys is None:
+            return False
+        return max_age is None or time.time() - self.built_at <= max_age
+
+    def find(self, prefix):
+        # first key starting with prefix, None when absent or the index is not built yet
+        keys = self.keys
+        if keys is None:
+            return None
+        i = bisect.bisect_left(keys, prefix)
+        if i < len(keys) and keys[i].startswith(prefix):
+            self.counters["hits"] += 1
+            return keys[i]
+        self.counters["misses"] += 1
+        return None
+
+
+_order_copy_index = None
+
+def get_order_copy_index(env):
+    global _order_copy_index
+    if _order_copy_index is None and env['order_index_enabled']:
+        _order_copy_index = OrderCopyIndex()
+        register_cache("order_copy_index", _order_copy_index)
+    return _order_copy_index
+
+
+class PresignedUrlCache:
+    # presigned urls keyed by bucket/key, reused while they still have at least
+    # min_ttl seconds of validity left and signed again after that
+
+    def __init__(self, max_items, min_ttl):
+        self.max_items = max_items
+        self.min_ttl = min_ttl
+        self.urls = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, bucket_name, object_key):
+        with self.lock:
+            entry = self.urls.get((bucket_name, object_key))
+            if entry is not None and entry[1] - time.time() >= self.min_ttl:
+                self.urls.move_to_end((bucket_name, object_key))
+                self.counters["hits"] += 1
+                return entry[0]
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, bucket_name, object_key, url, expiration):
+        with self.lock:
+            self.urls[(bucket_name, object_key)] = (url, time.time() + expiration)
+            self.urls.move_to_end((bucket_name, object_key))
+            while len(self.urls) > self.max_items:
+                self.urls.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def sizes(self):
+        with self.lock:
+            return {"items": len(self.urls)}
+
+
+_presigned_url_cache = None
+
+def get_presigned_url_cache(env):
+    global _presigned_url_cache
+    if _presigned_url_cache is None:
+        _presigned_url_cache = PresignedUrlCache(env['presign_cache_size'], env['presign_cache_min_ttl'])
+        register_cache("presigned_url", _presigned_url_cache)
+    return _presigned_url_cache
+
+
+class TtlCache:
+    # holds a value built by loader, rebuilt once it is older than ttl or after
+    # invalidate(). With ttl None it is only rebuilt by refresh() or invalidate()
+
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self.value = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.loaded_at is None or (self.ttl is not None and time.time() - self.loaded_at >= self.ttl):
+                self.value = self.loader()
+                self.loaded_at = time.time()
+            return self.value
+
+    def refresh(self):
+        # builds outside the lock so readers keep the old value until the swap
+        value = self.loader()
+        with self.lock:
+            self.value = value
+            self.loaded_at = time.time()
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
+
+
+class IpcRuleIndex:
+    # (act, section) hash index over a court_ipc_* rule table. Acts are lower
+    # cased and stripped, codes are kept both as ints and as strings so a section
+    # matches exactly when `int(section) in codes or section in codes` would
+
+    def __init__(self, rules):
+        self.types = set()
+        self.int_codes = set()
+        self.str_codes = set()
+        for rule_type, code in rules:
+            if not isinstance(rule_type, str):
+                continue
+            act = rule_type.lower().strip()
+            self.types.add(act)
+            if isinstance(code, str):
+                self.str_codes.add((act, code))
+                continue
+            # numeric columns come back as int, float or Decimal, keep every whole number
+            try:
+                if int(code) == code:
+                    self.int_codes.add((act, int(code)))
+            except (TypeError, ValueError, OverflowError):
+                pass
+
+    def match(self, act, section):
+        if (act, section) in self.str_codes:
+            return True
+        try:
+            return (act, int(section)) in self.int_codes
+        except (TypeError, ValueError):
+            return False
+
+
+class PincodeTable:
+    # pincode -> district, state, latitude, longitude held in sorted numpy arrays,
+    # the first row wins when a pincode appears more than once
+
+    def __init__(self, rows):
+        rows = [r for r in rows if r[0] is not None]
+        pincodes = np.array([int(r[0]) for r in rows], dtype=np.int64)
+        order = np.argsort(pincodes, kind="stable")
+        self.pincodes, first = np.unique(pincodes[order], return_index=True)
+        keep = order[first]
+        self.districts = np.array([rows[i][1] for i in keep], dtype=object)
+        self.states = np.array([rows[i][2] for i in keep], dtype=object)
+        self.latitudes = np.array([rows[i][3] for i in keep], dtype=np.float64)
+        self.longitudes = np.array([rows[i][4] for i in keep], dtype=np.float64)
+
+    def lookup(self, pincode):
+        # (district, state, latitude, longitude) or None when the pincode is unknown
+        try:
+            pincode = int(pincode)
+        except (TypeError, ValueError):
+            return None
+        i = np.searchsorted(self.pincodes, pincode)
+        if i < len(self.pincodes) and self.pincodes[i] == pincode:
+            return self.districts[i], self.states[i], self.latitudes[i], self.longitudes[i]
+        return None
+
+    def __len__(self):
+        return len(self.pincodes)
+
+
+def normalize_key(value):
+    return value.lower().strip() if isinstance(value, str) else None
+
+
+class CourtCatalogue:
+    # court reference data: cnr_part -> court coordinates, and (state, district) or
+    # state -> court names. Names are matched on lower cased, stripped keys the way
+    # the old ilike lookups matched them, at most max_names distinct courts per key
+
+    def __init__(self, court_rows, location_rows, max_names=15):
+        self.locations = pd.DataFrame(location_rows, columns=['cnr_part', 'latitude', 'longitude'])
+        self.locations['latitude'] = self.locations['latitude'].astype(np.float64)
+        self.locations['longitude'] = self.locations['longitude'].astype(np.float64)
+        by_district = {}
+        by_state = {}
+        for court_name, state_code_num, state, district in court_rows:
+            state_key = normalize_key(state)
+            if state_key is None:
+                continue
+            court = (str(court_name), state_code_num)
+            by_state.setdefault(state_key, set()).add(court)
+            district_key = normalize_key(district)
+            if district_key is not None:
+                by_district.setdefault((state_key, district_key), set()).add(court)
+        self.by_district = {key: self.court_names(courts, max_names) for key, courts in by_district.items()}
+        self.by_state = {key: self.court_names(courts, max_names) for key, courts in by_state.items()}
+
+    @staticmethod
+    def court_names(courts, max_names):
+        courts = sorted(courts, key=lambda court: (court[0], str(court[1])))
+        return [court_name for court_name, _ in courts[:max_names]]
+
+    def get_locations(self, cnr_parts):
+        # cnr_part, latitude, longitude rows for the given cnr parts
+        return self.locations[self.locations['cnr_part'].isin(cnr_parts)]
+
+    def get_court_names(self, district, state):
+        # district courts first, falling back to every court in the state
+        state_key = normalize_key(state)
+        court_names = self.by_district.get((state_key, normalize_key(district)), [])
+        if len(court_names) == 0:
+            court_names = self.by_state.get(state_key, [])
+        return list(court_names)
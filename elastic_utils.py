@@ -1,26 +1,70 @@
+import re
 import json
 import logging
 from typing import Dict
 from elasticsearch import AsyncElasticsearch
 import tqdm
 import asyncio
-from thefuzz import fuzz
+from rapidfuzz import process as rf_process, fuzz as rf_fuzz
+import numpy as np
 import pandas as pd
-from functools import partial
-from sqlalchemy import create_engine, text
-from utils import haversine_vectorize
+from utils import haversine_vectorize, get_pincode_table, get_court_catalogue
+from utils import run_blocking, run_cpu, fetch_rows
 from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
 import requests
+import aiohttp
 
 from custom_exceptions import CaseStatusException
+from cache_utils import get_html_cache
+from metrics_utils import time_stage
 
 
-def get_es_client(cloud_id, api_id, api_key):
-    return AsyncElasticsearch(
-        cloud_id=cloud_id,
-        api_key=(api_id , api_key), timeout=100
+_es_client = None
 
-)
+def get_es_client(env):
+    # long lived client, created once at startup and shared by every search
+    global _es_client
+    if _es_client is None:
+        # ES_HOSTS points the worker at a self managed or local cluster instead of elastic cloud
+        if env['es_hosts']:
+            endpoint = {"hosts": env['es_hosts'].split(",")}
+        else:
+            endpoint = {"cloud_id": env['cloud_id']}
+        _es_client = AsyncElasticsearch(
+            **endpoint,
+            api_key=(env['api_id'], env['api_key']) if env['api_id'] else None,
+            connections_per_node=env['es_connections_per_node'],
+            request_timeout=env['es_request_timeout'],
+            max_retries=env['es_max_retries'],
+            retry_on_timeout=True
+        )
+    return _es_client
+
+async def close_es_client():
+    global _es_client
+    if _es_client is not None:
+        await _es_client.close()
+        _es_client = None
+
+_http_session = None
+
+def get_http_session(env):
+    # pooled session for the case details downloads, must be created inside the event loop
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=env['html_fetch_concurrency']),
+            timeout=aiohttp.ClientTimeout(total=env['html_fetch_timeout'])
+        )
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
 
 class QueryBuilder:
     
@@ -35,16 +79,20 @@ class QueryBuilder:
             self.modified_name = name.lower()
             self.use_modified_name = 0
         self.pincode = pincode
-        db_string = env['db_string']
-        engine = create_engine(db_string)
-        with engine.connect() as connect:
-            query = f"select district, state from pincode where pincode = {pincode}"
-            try:
-                district, state = connect.execute(text(query)).fetchall()[0]
-                connect.commit()
-            except IndexError:
-                raise CaseStatusException("Pincode not found", 203, "red")
-            
+        self.source_fields = ['cnr', 'name', 'party_type', 'relative', 'relation_type', 'case_location', 
+                              'case_state', 'case_district', 'case_court', 
+                              'case_stage', 'fir_police_station', 'act_section', 'order_exists']
+        pincode_details = get_pincode_table(env).lookup(pincode)
+        if pincode_details is None:
+            raise CaseStatusException("Pincode not found", 203, "red")
+        district, state, latitude, longitude = pincode_details
+        # optional geo pruning on the court location stored with each document
+        self.latitude = latitude
+        self.longitude = longitude
+        self.geo_mode = env['es_geo_mode'] if not (np.isnan(latitude) or np.isnan(longitude)) else "off"
+        self.geo_field = env['es_geo_field']
+        self.geo_distance_km = env['es_geo_distance_km']
+
         self.case_state = state.lower()
         self.case_district = district.lower()
         
@@ -206,53 +254,328 @@ class QueryBuilder:
             }
         }
 
-    def get_query_list(self):
+    def get_query_names(self):
         if self.use_modified_name == 1:
-            query_list = [self.name_query,
-                          self.modified_name_query, 
-                          self.name_district_query, 
-                          self.name_state_query, 
-                          self.name_father_query,
-                          self.name_father_district_query, 
-                          self.name_father_state_query
-                        ]
-        else:
-            query_list = [self.name_query, 
-                          self.name_district_query, 
-                          self.name_state_query, 
-                          self.name_father_query,
-                          self.name_father_district_query, 
-                          self.name_father_state_query
+            query_names = ['name_query',
+                           'modified_name_query', 
+                           'name_district_query', 
+                           'name_state_query', 
+                           'name_father_query',
+                           'name_father_district_query', 
+                           'name_father_state_query'
                           ]
-        return query_list
+        else:
+            query_names = ['name_query', 
+                           'name_district_query', 
+                           'name_state_query', 
+                           'name_father_query',
+                           'name_father_district_query', 
+                           'name_father_state_query'
+                           ]
+        return query_names
 
+    def get_query_list(self):
+        # only the fields the pipeline reads are pulled from _source
+        return [{**self.with_geo(getattr(self, query_name)), "_source": self.source_fields} 
+                for query_name in self.get_query_names()]
 
-async def search_query(env, query, size=100):
-    async with AsyncElasticsearch(cloud_id=env['cloud_id'], api_key=(env['api_id'], env['api_key']), timeout=100) as es:
-        result = await es.search(index=env['index_name'], body=query, size=100, )
-        return result
+    def with_geo(self, query):
+        # "filter" drops documents whose court is further than geo_distance_km,
+        # "decay" keeps them but scales their score down with the distance.
+        # Documents without a court location are never dropped
+        origin = {"lat": float(self.latitude), "lon": float(self.longitude)}
+        if self.geo_mode == "filter":
+            return {**query, 
+                    "query": {
+                        "bool": {
+                            "must": [query["query"]],
+                            "filter": [
+                                {
+                                "bool": {
+                                    "should": [
+                                        {"geo_distance": {"distance": f"{self.geo_distance_km}km", self.geo_field: origin}},
+                                        {"bool": {"must_not": {"exists": {"field": self.geo_field}}}}
+                                    ],
+                                    "minimum_should_match": 1
+                                }
+                                }
+                            ]
+                        }
+                    }
+                }
+        if self.geo_mode == "decay":
+            return {**query, 
+                    "query": {
+                        "function_score": {
+                            "query": query["query"],
+                            "functions": [
+                                {
+                                "gauss": {self.geo_field: {"origin": origin, 
+                                                           "scale": f"{self.geo_distance_km}km", 
+                                                           "decay": 0.5}}
+                                }
+                            ],
+                            "boost_mode": "multiply"
+                        }
+                    }
+                }
+        return query
+
+
+class HitCollector:
+    # the cascade queries overlap heavily, hits are merged by _id as pages arrive,
+    # keeping one copy of every document and the queries that returned it. Documents
+    # come back in cascade order whatever order the pages arrived in
+
+    def __init__(self, query_names):
+        self.query_rank = {query_name: rank for rank, query_name in enumerate(query_names)}
+        self.positions = {query_name: 0 for query_name in query_names}
+        self.sources = {}
+        self.matched_queries = {}
+        self.first_seen = {}
+
+    def add(self, query_name, hits):
+        for hit in hits:
+            doc_id = hit['_id']
+            seen = (self.query_rank[query_name], self.positions[query_name])
+            self.positions[query_name] += 1
+            if doc_id not in self.sources:
+                self.sources[doc_id] = hit['_source']
+                self.matched_queries[doc_id] = []
+                self.first_seen[doc_id] = seen
+            self.first_seen[doc_id] = min(self.first_seen[doc_id], seen)
+            if query_name not in self.matched_queries[doc_id]:
+                self.matched_queries[doc_id].append(query_name)
+
+    def get_hits(self):
+        doc_ids = sorted(self.sources, key=self.first_seen.get)
+        return [(self.sources[doc_id], sorted(self.matched_queries[doc_id], key=self.query_rank.get)) 
+                for doc_id in doc_ids]
+
+
+async def search_query(env, query, size=100, query_name=None, collector=None):
+    es = get_es_client(env)
+    if not env['es_paging']:
+        result = await es.search(index=env['index_name'], body={**query, "size": size})
+        collector.add(query_name, result['hits']['hits'])
+        return
+    # search_after over a point in time, page by page up to es_max_hits
+    pit = await es.open_point_in_time(index=env['index_name'], keep_alive=env['es_pit_keep_alive'])
+    pit_id = pit['id']
+    fetched = 0
+    search_after = None
+    try:
+        while fetched < env['es_max_hits']:
+            page_size = min(size, env['es_max_hits'] - fetched)
+            body = {**query, 
+                    "size": page_size,
+                    "pit": {"id": pit_id, "keep_alive": env['es_pit_keep_alive']},
+                    "sort": [{"_score": "desc"}, {"_shard_doc": "asc"}]}
+            if search_after is not None:
+                body["search_after"] = search_after
+            result = await es.search(body=body)
+            hits = result['hits']['hits']
+            collector.add(query_name, hits)
+            fetched += len(hits)
+            if len(hits) < page_size:
+                break
+            search_after = hits[-1]['sort']
+            pit_id = result.get('pit_id', pit_id)
+    finally:
+        await es.close_point_in_time(id=pit_id)
     
+async def msearch_query(env, query_list, size=100):
+    # header/body pairs for a single _msearch round trip
+    body = []
+    for query in query_list:
+        body.append({"index": env['index_name']})
+        body.append({**query, "size": size})
+    es = get_es_client(env)
+    result = await es.msearch(body=body)
+    # failed sub-searches come back as {"error": ...} entries, the caller checks them
+    return result['responses']
+
+async def get_search_batch(env, qb_instances, size=100):
+    # packs the query cascade of several cases into one _msearch and collects
+    # the responses back per case, in the order the queries were sent. A case with
+    # a failed query gets an exception in place of its collector, the others are
+    # not affected by it
+    query_lists = [qb.get_query_list() for qb in qb_instances]
+    responses = await msearch_query(env, [q for ql in query_lists for q in ql], size)
+    collectors = []
+    start = 0
+    for qb, ql in zip(qb_instances, query_lists):
+        case_responses = responses[start:start + len(ql)]
+        start += len(ql)
+        errors = [resp['error'] for resp in case_responses if 'error' in resp]
+        if errors:
+            collectors.append(RuntimeError(f"msearch query failed: {errors[0]}"))
+            continue
+        collector = HitCollector(qb.get_query_names())
+        for query_name, response in zip(qb.get_query_names(), case_responses):
+            collector.add(query_name, response['hits']['hits'])
+        collectors.append(collector)
+    return collectors
+
+class SearchBatcher:
+    # the cases of a claimed batch reach get_search together, their cascades are packed
+    # into one _msearch instead of a round trip per case. Searches are sent once
+    # worker_batch_size cases are waiting or the first has waited es_msearch_window seconds
+
+    def __init__(self, env):
+        self.env = env
+        self.pending = []
+        self.timer = None
+        self.batches = set()
+
+    async def search(self, qb_instance, size):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((qb_instance, size, future))
+        if len(self.pending) >= self.env['worker_batch_size']:
+            self.start_batch()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.env['es_msearch_window'], self.start_batch)
+        return await future
+
+    def start_batch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        by_size = {}
+        for item in batch:
+            by_size.setdefault(item[1], []).append(item)
+        for size, items in by_size.items():
+            task = asyncio.create_task(self.send(items, size))
+            self.batches.add(task)
+            task.add_done_callback(self.batches.discard)
+
+    async def send(self, items, size):
+        try:
+            collectors = await get_search_batch(self.env, [qb_instance for qb_instance, _, _ in items], size)
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), collector in zip(items, collectors):
+            if future.done():
+                continue
+            if isinstance(collector, Exception):
+                future.set_exception(collector)
+            else:
+                future.set_result(collector)
+
+_search_batcher = None
+
+def get_search_batcher(env):
+    global _search_batcher
+    if _search_batcher is None:
+        _search_batcher = SearchBatcher(env)
+    return _search_batcher
+
 async def get_search(env, qb_instance, size=100):
-    query_list = qb_instance.get_query_list()
-    tasks = [asyncio.create_task(search_query(env, query, size )) for query in query_list]
-    
-    responses = await asyncio.gather(*tasks)
-    return responses
+    # msearch mode sends a single page per query, paging applies to separate searches
+    if env['es_use_msearch']:
+        collector = await get_search_batcher(env).search(qb_instance, size)
+    else:
+        collector = HitCollector(qb_instance.get_query_names())
+        tasks = [asyncio.create_task(search_query(env, query, size, query_name, collector)) 
+                 for query_name, query in zip(qb_instance.get_query_names(), qb_instance.get_query_list())]
+        
+        await asyncio.gather(*tasks)
+    if qb_instance.geo_mode == "filter" and len(collector.sources) == 0:
+        # nothing near the candidate, search again without the geo filter the same
+        # way process_crc keeps far away courts when no court is within 100 km
+        qb_instance.geo_mode = "off"
+        collector = await get_search(env, qb_instance, size)
+    return collector
 
-def process_response(env, qb_instance, responses):
-    parse_partial = partial(parse_elastic_result, qb_instance)
-    result = [parse_partial(resp) for resp in responses]
-    result = pd.concat(result)
+async def process_response(env, qb_instance, collector):
+    with time_stage("candidates"):
+        result = await run_cpu(env, build_candidates, qb_instance, collector.get_hits(), env['fuzzy_workers'])
+    if result.empty:
+        return result
     result['cnr_part'] = result['cnr'].str[:6]
-    result = get_distance(result, env)
+    with time_stage("distance"):
+        result = await get_distance(result, env)
     return result
 
+def build_candidates(qb_instance, hits, workers=1):
+    result = parse_elastic_result(qb_instance, hits)
+    if result.empty:
+        return result
+    return score_candidates(qb_instance, result, workers)
+
+def get_match_matrix(queries, choices, workers=1):
+    # fuzz.ratio of every query against every choice in a single cdist call. thefuzz
+    # returns 0 for None, 100 for equal strings, 0 for an empty string and otherwise
+    # the ratio rounded half to even, which np.round reproduces on the float64 scores
+    choices = np.asarray(choices, dtype=object)
+    is_text = np.array([isinstance(c, str) for c in choices], dtype=bool)
+    cleaned = np.where(is_text, choices, "").tolist()
+    scores = rf_process.cdist(queries, cleaned, scorer=rf_fuzz.ratio, dtype=np.float64, workers=workers)
+    scores = np.round(scores)
+    is_empty = is_text & (np.array([len(c) for c in cleaned]) == 0)
+    for i, query in enumerate(queries):
+        is_equal = is_text & (choices == query)
+        scores[i][(is_empty & ~is_equal) | ~is_text] = 0
+        scores[i][is_equal] = 100
+    return scores.astype(int)
+
 def get_match(name, name_list):
-    return [fuzz.ratio(name, nl) for nl in name_list]
+    return get_match_matrix([name], name_list)[0].tolist()
 
-def get_act_section(cnr, html_link):
+def score_candidates(qb_instance, result_df, workers=1):
+    # the four fuzzy score columns from one batched call over the unique names and relatives
+    names = result_df['name'].values
+    relatives = result_df['relative'].values
+    choices = pd.unique(np.concatenate([names, relatives]))
+    scores = get_match_matrix([qb_instance.name, qb_instance.father_name, qb_instance.modified_name], 
+                              choices, workers)
+    position = pd.Index(choices)
+    name_idx = position.get_indexer(names)
+    relative_idx = position.get_indexer(relatives)
+    result_df['name_match'] = scores[0][name_idx]
+    result_df['percentage_father_in_name'] = scores[1][name_idx]
+    result_df['modified_name_match'] = scores[2][name_idx]
+    result_df['father_name_match'] = scores[1][relative_idx]
+    return result_df
+
+def get_act_section(cnr, html_link, timeout=30):
     
-    contents = requests.get(html_link).text
+    contents = requests.get(html_link, timeout=timeout).text
+    return parse_act_section(cnr, contents)
+
+ACTS_TABLE_XPATH = etree.XPath("//table[contains(concat(' ', normalize-space(@class), ' '), ' Acts_table ')]")
+
+def parse_act_section(cnr, contents):
+    # lxml parses the page in C and the xpath goes straight to the Acts_table,
+    # the output matches parse_act_section_bs4 row for row
+    if contents is None or len(contents.strip()) == 0:
+        return pd.DataFrame()
+    parser = lxml.html.HTMLParser(encoding='utf-8')
+    try:
+        root = lxml.html.document_fromstring(contents.encode('utf-8'), parser=parser)
+    except etree.ParserError:
+        # a body without any element, e.g. only a comment, has no acts table either
+        return pd.DataFrame()
+    tables = ACTS_TABLE_XPATH(root)
+    if len(tables) > 0:
+        act_section = []
+        for row in tables[0].iter('tr'):
+            cols = [col.text_content() for col in row.iter('td')]
+            if len(cols) > 0:
+                act_section.append(cols)
+        act_section_df = pd.DataFrame(act_section, columns=['act', 'section'])
+        act_section_df['cnr'] = cnr
+        return act_section_df[['cnr', 'act', 'section']]
+    else:
+        return pd.DataFrame()
+
+def parse_act_section_bs4(cnr, contents):
+    # reference implementation, kept to verify parse_act_section against saved pages
 
     soup = BeautifulSoup(contents, 'html.parser')
     table = soup.find("table", {"class": 'Acts_table'})
@@ -281,104 +604,116 @@ def get_act_section(cnr, html_link):
     else:
         return pd.DataFrame()
 
+async def fetch_html(env, session, cache, cnr, html_link):
+    cached = await run_blocking(env, cache.get, cnr) if cache is not None else None
+    if cached is not None:
+        contents, etag, is_fresh = cached
+        if is_fresh:
+            return contents
+    headers = {"If-None-Match": cached[1]} if cached is not None and cached[1] else {}
+    async with session.get(html_link, headers=headers) as response:
+        if response.status == 304:
+            await run_blocking(env, cache.revalidated, cnr)
+            return cached[0]
+        contents = await response.text()
+        if cache is not None and response.status == 200:
+            await run_blocking(env, cache.put, cnr, contents, response.headers.get("ETag"))
+    return contents
+
+async def fetch_act_section(env, session, semaphore, cache, cnr, html_link):
+    async with semaphore:
+        contents = await fetch_html(env, session, cache, cnr, html_link)
+    return await run_cpu(env, parse_act_section, cnr, contents)
+
+async def get_act_sections(env, result):
+    # downloads the case details of every matched cnr concurrently over the pooled
+    # session and returns the combined cnr/act/section frame
+    session = get_http_session(env)
+    cache = get_html_cache(env)
+    semaphore = asyncio.Semaphore(env['html_fetch_concurrency'])
+    tasks = [fetch_act_section(env, session, semaphore, cache, cnr, html_link) 
+             for cnr, html_link in zip(result['cnr'], result['case_details_url'])]
+    res = await asyncio.gather(*tasks)
+    return pd.concat(res)
+
+
+def char_overlap(values, text):
+    # 1 when the value shares any character with text, same as the old
+    # set(text).intersection(value) check
+    chars = set(text.lower().strip())
+    if len(chars) == 0:
+        return pd.Series(0, index=values.index)
+    pattern = "[" + "".join(re.escape(c) for c in chars) + "]"
+    return values.str.lower().str.strip().str.contains(pattern, regex=True, na=False).astype(int)
+
+def token_overlap(values, text):
+    # 1 when the value shares any space separated token with text
+    tokens = set(text.lower().split(" "))
+    exploded = values.str.lower().str.split(" ").explode()
+    return exploded.isin(tokens).groupby(level=0).any().astype(int)
 
-def parse_elastic_result(qb_instance, result):
+def parse_elastic_result(qb_instance, hits):
     name = qb_instance.name
     father_name = qb_instance.father_name
     modified_name = qb_instance.modified_name
     district = qb_instance.case_district
     state = qb_instance.case_state
-    hits = result['hits']['hits']
-    result_list = []
-    for hit in hits:
-        source = hit['_source']
-        values = list(source.values())
-        keys = list(source.keys())
-        result_list.append(values)
-    if len(result_list) > 0:
-        result_df = pd.DataFrame (result_list, columns=keys)
+    if len(hits) > 0:
+        result_df = pd.DataFrame([source for source, _ in hits])
+        result_df['matched_queries'] = [",".join(query_names) for _, query_names in hits]
+        result_df['matched_query_count'] = [len(query_names) for _, query_names in hits]
         result_df['input_name'] = name
         result_df['input_father_name'] = father_name
         result_df['input_district'] = district
         result_df['input_state'] = state
         result_df['input_modified_name'] = modified_name
         result_df['input_pincode'] = qb_instance.pincode
-        result_df['name_match'] = get_match(name, 
-                                            result_df['name'].values.tolist())
 
-        result_df['percentage_father_in_name'] = get_match(father_name, 
-                                            result_df['name'].values.tolist())
-
-        result_df['modified_name_match'] = get_match(modified_name, 
-                                                     result_df['name'].values.tolist())
-        result_df['father_name_match'] = get_match(father_name, 
-                                                   result_df['relative'].values.tolist())
-
-        
         # result_df["district_match"] = get_match(district, 
         #                                         result_df['case_district'].values.tolist())
         # result_df['state_match'] = get_match(state, result_df['case_state'].values.tolist())
 
-        result_df['in_same_district']=result_df.apply(lambda x: 1 if len(set(x['input_district'].lower().strip()).intersection(
-                x['case_district'].lower().strip())) > 0 else 0 , axis=1)
-    
-        result_df['in_same_state']=result_df.apply(lambda x: 1 if len(set(x['input_state'].lower().strip()).intersection(
-                x['case_state'].lower().strip())) > 0 else 0 , axis=1)
-       
-
-        result_df['father_in_name']  = result_df.apply(lambda x: 
-            1 if len(set(x['input_father_name'].lower().split(" ")).intersection(x['name'].lower().split(" "))) > 0 else 0 , axis=1)
+        result_df['in_same_district'] = char_overlap(result_df['case_district'], district)
+        result_df['in_same_state'] = char_overlap(result_df['case_state'], state)
+        result_df['father_in_name'] = token_overlap(result_df['name'], father_name)
     else:
         result_df = pd.DataFrame()
     return result_df
 
 
-def get_distance(result, env):
-    cnr_list = tuple(result.cnr.unique().tolist())
-    cnr_part_list = tuple(result.cnr_part.unique().tolist())
+async def get_distance(result, env):
+    cnr_list = result.cnr.unique().tolist()
     candidate_pincode = result.input_pincode.unique()[0]
-    db = create_engine(env['db_string'])
-    with db.connect() as connect:
-        candidate_lat_lon = connect.execute(text(f"select latitude, longitude from pincode where pincode = {candidate_pincode}")).fetchall()
-        fir_idx = pd.DataFrame(
-            connect.execute(
-                text(
-                    f"select cnr, idx_list from {env['cnr_fir_idx']} where cnr in {cnr_list}"
-                    )))
-        fir_idx_expanded = fir_idx.explode("idx_list")
-        fir_idx_expanded['cnr'] = fir_idx_expanded['cnr'].str.strip()
-        fir_idx_expanded['idx_list'] =fir_idx_expanded['idx_list'].astype(int)
-        idx_list = tuple(fir_idx_expanded.idx_list.values.tolist())
-        cnr_lat_lon = pd.DataFrame(
-            connect.execute(
-                text(
-                    f"select cnr, latitude, longitude, idx from {env['cnr_fir_pincode']} where idx in {idx_list}"
-                    )))
-        
-        cnr_court_lat_lon = pd.DataFrame(
-            connect.execute(
-                text(
-                    f"select cnr_part, latitude, longitude from {env['court_pincode']} where cnr_part in {cnr_part_list}"
-        )))
-    latitude, longitude = candidate_lat_lon[0]
+    _, _, latitude, longitude = get_pincode_table(env).lookup(candidate_pincode)
+    # one round trip: expand every cnr's police station idx_list, join their
+    # coordinates and keep the minimum haversine distance per cnr
+    query_police_station = f"""select trim(f.cnr) as cnr, 
+                               min(6367 * 2 * asin(least(1, sqrt(
+                                   power(sin(radians(p.latitude - :latitude) / 2), 2) + 
+                                   cos(radians(:latitude)) * cos(radians(p.latitude)) * 
+                                   power(sin(radians(p.longitude - :longitude) / 2), 2))))) as police_station_distance
+                               from {env['cnr_fir_idx']} f 
+                               cross join lateral unnest(f.idx_list) as i(idx)
+                               join {env['cnr_fir_pincode']} p on p.idx = i.idx::int
+                               where f.cnr = any(:cnr_list) 
+                               and p.latitude is not null and p.longitude is not null
+                               group by trim(f.cnr)"""
+    cnr_lat_lon = pd.DataFrame(
+        await fetch_rows(env, 
+                         query_police_station, 
+                         {"latitude": float(latitude), "longitude": float(longitude), "cnr_list": cnr_list}
+                         ), 
+        columns=['cnr', 'police_station_distance'])
+
+    cnr_court_lat_lon = get_court_catalogue(env).get_locations(result.cnr_part.unique()).copy()
     cnr_court_lat_lon['court_distance'] = haversine_vectorize(longitude, 
                                                               latitude, 
                                                               cnr_court_lat_lon.longitude.values,
                                                               cnr_court_lat_lon.latitude.values
                                                               )
     
-    cnr_lat_lon['police_station_distance'] = haversine_vectorize(longitude, 
-                                                             latitude, 
-                                                             cnr_lat_lon.longitude.values,
-                                                             cnr_lat_lon.latitude.values)
-    # If a police station have multiple lat-lon, we might end up getting multiple distance
-    # for a CNR, we retain the minimum distance
-    cnr_lat_lon.sort_values("police_station_distance", inplace=True)
-    cnr_lat_lon.drop_duplicates(subset="police_station_distance", keep="first", inplace=True)
+    cnr_lat_lon['police_station_distance'] = cnr_lat_lon['police_station_distance'].astype(float)
     result = pd.merge(result, cnr_lat_lon[['cnr', 'police_station_distance']], on="cnr", how="left")
     result = pd.merge(result, cnr_court_lat_lon[['cnr_part', 'court_distance']], on="cnr_part", how="left")
     
     return result
-    
-        
-    
\ No newline at end of file
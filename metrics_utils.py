@@ -0,0 +1,53 @@
+import time
+from contextlib import contextmanager
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+stage_seconds = Histogram("crc_stage_seconds", "Time spent in each stage of a case", ["stage"], buckets=STAGE_BUCKETS)
+case_seconds = Histogram("crc_case_seconds", "End to end time of a case", buckets=STAGE_BUCKETS)
+cases_total = Counter("crc_cases_total", "Finished cases by outcome status code", ["status"])
+queue_depth = Gauge("crc_queue_depth", "Cases waiting in the queue")
+cases_in_flight = Gauge("crc_cases_in_flight", "Cases being processed by this worker")
+
+@contextmanager
+def time_stage(stage):
+    # observed when the block exits, also when it raises
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(stage).observe(time.perf_counter() - start)
+
+def record_case(status, started):
+    cases_total.labels(str(status)).inc()
+    case_seconds.observe(time.perf_counter() - started)
+
+class CacheCollector:
+    # reads the counters the caches keep at scrape time, so the caches themselves
+    # stay free of prometheus calls on their hot paths
+
+    def __init__(self):
+        self.caches = {}
+
+    def register(self, name, cache):
+        self.caches[name] = cache
+
+    def collect(self):
+        events = CounterMetricFamily("crc_cache_events", "Cache hits, misses and evictions by cache", labels=["cache", "event"])
+        sizes = GaugeMetricFamily("crc_cache_size", "Current size of each cache", labels=["cache", "unit"])
+        for name, cache in list(self.caches.items()):
+            for event, count in dict(cache.counters).items():
+                events.add_metric([name, event], count)
+            for unit, size in cache.sizes().items():
+                sizes.add_metric([name, unit], size)
+        yield events
+        yield sizes
+
+cache_collector = CacheCollector()
+REGISTRY.register(cache_collector)
+
+def register_cache(name, cache):
+    cache_collector.register(name, cache)
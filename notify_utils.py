@@ -0,0 +1,186 @@
+import json
+import time
+import asyncio
+import logging
+import aiohttp
+from sqlalchemy import text
+from utils import get_engine, fetch_rows
+
+
+_notify_session = None
+
+def get_notify_session(env):
+    # pooled session for the notify api, must be created inside the event loop
+    global _notify_session
+    if _notify_session is None or _notify_session.closed:
+        _notify_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=env['notify_concurrency']),
+            timeout=aiohttp.ClientTimeout(total=env['notify_timeout'])
+        )
+    return _notify_session
+
+async def close_notify_session():
+    global _notify_session
+    if _notify_session is not None:
+        await _notify_session.close()
+        _notify_session = None
+
+async def post_notification(env, verify_ids):
+    # a single case keeps the {"ref_id": ...} payload, with NOTIFY_BATCH_SIZE > 1
+    # the endpoint is expected to accept {"ref_ids": [...]}
+    session = get_notify_session(env)
+    headers = {'Content-Type': 'application/json',
+               'Authorization': env['notify_token']}
+    if len(verify_ids) == 1:
+        data = {"ref_id": str(verify_ids[0])}
+    else:
+        data = {"ref_ids": [str(verify_id) for verify_id in verify_ids]}
+    try:
+        async with session.post(env['notify_url'], headers=headers, data=json.dumps(data)) as response:
+            return response.status
+    except Exception as e:
+        logging.info(f"Failed to send request to notify api, {e}")
+        return 0
+
+async def notify_case(env, verify_id):
+    # direct delivery when the outbox is disabled, a single attempt so a slow or
+    # failing notify api never holds a worker slot. Retries belong to the outbox
+    return await post_notification(env, [verify_id])
+
+def install_notify_outbox(env):
+    # cases commit their notification in the same transaction as the result, so
+    # the worker must not start when the table is missing and can not be created
+    table = env['notify_outbox_table']
+    query_exists = f"""select to_regclass('{table}')"""
+    query_table = f"""create table if not exists {table} (
+                        id bigserial primary key,
+                        idx text not null,
+                        created_on timestamp not null default now(),
+                        attempts integer not null default 0,
+                        next_attempt_on timestamp not null default now(),
+                        sent_on timestamp,
+                        last_status integer)"""
+    query_index = f"""create index if not exists {table}_due_idx on {table} (next_attempt_on) where sent_on is null"""
+    query_sent_index = f"""create index if not exists {table}_sent_idx on {table} (sent_on) where sent_on is not null"""
+    engine = get_engine(env)
+    with engine.connect() as connect:
+        if connect.execute(text(query_exists)).scalar() is None:
+            connect.execute(text(query_table))
+            connect.execute(text(query_index))
+            connect.execute(text(query_sent_index))
+            connect.commit()
+        if connect.execute(text(query_exists)).scalar() is None:
+            raise RuntimeError(f"Notify outbox table {table} does not exist")
+
+class NotifyDispatcher:
+    # delivers the notifications the cases commit to the outbox. Due rows are claimed
+    # with skip locked and leased, so a worker that dies mid send only delays them,
+    # failed rows are retried with exponential backoff until notify_max_attempts.
+    # Sent and exhausted rows are pruned once they are older than notify_retention
+
+    def __init__(self, env):
+        self.env = env
+        self.event = asyncio.Event()
+        self.pruned_at = 0
+        table = env['notify_outbox_table']
+        self.query_claim = f"""update {table} set attempts = attempts + 1,
+                               next_attempt_on = now() + make_interval(secs => :lease)
+                               where id in (select id from {table}
+                                            where sent_on is null and attempts < :max_attempts and next_attempt_on <= now()
+                                            order by id limit :limit
+                                            for update skip locked)
+                               returning id, idx"""
+        self.query_sent = f"""update {table} set sent_on = now(), last_status = :status where id = any(:ids)"""
+        self.query_failed = f"""update {table} set last_status = :status,
+                                next_attempt_on = now() + make_interval(secs => least(:backoff * power(2, attempts - 1), :backoff_max))
+                                where id = any(:ids)"""
+        self.query_prune = f"""delete from {table} where id in (select id from {table}
+                                                               where (sent_on < now() - make_interval(secs => :retention))
+                                                                  or (sent_on is null and attempts >= :max_attempts
+                                                                      and next_attempt_on < now() - make_interval(secs => :retention))
+                                                               limit :limit
+                                                               for update skip locked)
+                               returning id"""
+
+    def wake(self):
+        self.event.set()
+
+    async def run(self):
+        while True:
+            try:
+                claimed = await self.dispatch()
+            except Exception as e:
+                logging.info(f"Notify dispatch failed: {e}")
+                claimed = 0
+            if time.time() - self.pruned_at >= self.env['notify_prune_interval']:
+                try:
+                    await self.prune()
+                except Exception as e:
+                    logging.info(f"Notify outbox prune failed: {e}")
+                self.pruned_at = time.time()
+            # keep draining while full batches are due, otherwise wait for a new case
+            if claimed < self.get_claim_limit():
+                try:
+                    await asyncio.wait_for(self.event.wait(), self.env['notify_poll_interval'])
+                except asyncio.TimeoutError:
+                    pass
+                self.event.clear()
+
+    def get_claim_limit(self):
+        return self.env['notify_concurrency'] * self.env['notify_batch_size']
+
+    async def dispatch(self):
+        env = self.env
+        # the lease outlives every send of this round, one timeout per batch per slot
+        rows = await fetch_rows(env, self.query_claim,
+                                {"lease": float(env['notify_timeout'] * (env['notify_batch_size'] + 2)),
+                                 "max_attempts": env['notify_max_attempts'],
+                                 "limit": self.get_claim_limit()},
+                                commit=True)
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(env['notify_concurrency'])
+        batch_size = env['notify_batch_size']
+        batches = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+        status_codes = await asyncio.gather(*[self.send(semaphore, batch) for batch in batches])
+
+        outcomes = {}
+        for batch, status_code in zip(batches, status_codes):
+            outcomes.setdefault(status_code, []).extend(row[0] for row in batch)
+        for status_code, ids in outcomes.items():
+            if 200 <= status_code < 300:
+                await fetch_rows(env, self.query_sent, {"status": status_code, "ids": ids}, commit=True)
+            else:
+                logging.info(f"Notify api returned {status_code} for {len(ids)} cases, retrying later")
+                await fetch_rows(env, self.query_failed,
+                                 {"status": status_code, "ids": ids,
+                                  "backoff": float(env['notify_backoff']), "backoff_max": float(env['notify_backoff_max'])},
+                                 commit=True)
+        return len(rows)
+
+    async def prune(self, limit=10000):
+        # in chunks, so a large backlog never holds locks on the whole table
+        params = {"retention": float(self.env['notify_retention']),
+                  "max_attempts": self.env['notify_max_attempts'],
+                  "limit": limit}
+        pruned = 0
+        while True:
+            rows = await fetch_rows(self.env, self.query_prune, params, commit=True)
+            pruned += len(rows)
+            if len(rows) < limit:
+                break
+        if pruned > 0:
+            logging.info(f"Pruned {pruned} rows from the notify outbox")
+        return pruned
+
+    async def send(self, semaphore, batch):
+        async with semaphore:
+            return await post_notification(self.env, [row[1] for row in batch])
+
+_notify_dispatcher = None
+
+def get_notify_dispatcher(env):
+    global _notify_dispatcher
+    if _notify_dispatcher is None:
+        _notify_dispatcher = NotifyDispatcher(env)
+    return _notify_dispatcher
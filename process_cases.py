@@ -1,18 +1,21 @@
 import pandas as pd
-from utils import get_env, get_case
-from elastic_utils import QueryBuilder, get_search, process_response, get_act_section
+from utils import get_env, install_queue_trigger, QueueListener, refresh_reference_data
+from elastic_utils import QueryBuilder, get_search, process_response, get_act_sections
+from elastic_utils import get_es_client, close_es_client, close_http_session
 from custom_exceptions import CaseStatusException
-from sqlalchemy import create_engine, text, Table, Column, Integer, JSON, String, MetaData
-import json
 import asyncio
-import boto3
+import time
 from datetime import datetime
-from utils import get_temporary_s3_url, list_objects_with_key
-from utils import mark_green, mark_red, get_court_names, json_response_builder, write_final_response, call_notify_api
+from utils import get_s3_client, add_s3_urls, run_blocking, shutdown_executors
+from utils import get_cases_async, requeue_cases, get_queue_depth, get_result_writer, close_result_writer, close_async_engine
+from cache_utils import get_order_copy_index
+from utils import mark_green, mark_red, get_court_names, json_response_builder, build_report_row, build_records, install_jsonb_columns
+from notify_utils import get_notify_dispatcher, notify_case, install_notify_outbox, close_notify_session
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from metrics_utils import time_stage, record_case, queue_depth, cases_in_flight
 from fastapi.logger import logger as fastapi_logger
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import logging
 logging.basicConfig(format="%(asctime)s %(levelname)s:%(message)s",
                     level=logging.INFO,
@@ -35,21 +38,32 @@ fastapi_logger = logging.getLogger(__name__)
 
 app = FastAPI(title="crc worker",
               description="worker service to read the crc details from the postgres queue and process it accordingly")
-scheduler = AsyncIOScheduler()
+background_tasks = []
 
 
-async def process_crc():
-    fastapi_logger.info("Getting environment variable")
-    env = get_env()
-    fastapi_logger.info("Getting cases from the queue")
-    case = get_case(env)
-    
-    if len(case) > 0:
-        fastapi_logger.info("There are cases to be processed")
-        case = case[0]
+def get_outbox_rows(env, idx):
+    # with the outbox the notification is committed together with the result
+    return [{"idx": idx}] if env['notify_outbox'] else []
+
+async def notify(env, idx):
+    if env['notify_outbox']:
+        get_notify_dispatcher(env).wake()
     else:
-        fastapi_logger.info("There are no cases to be processed")
-        return
+        with time_stage("notify"):
+            notify_status_code = await notify_case(env, idx)
+        fastapi_logger.info(f"Notify api status code: {notify_status_code}")
+
+def mark_case_status(env, result):
+    result, green_failed = mark_green(env, result)
+    result, red_failed = mark_red(env, result)
+    return result
+
+async def write_failed_status(env, idx, emp_id, started):
+    with time_stage("db_write"):
+        await get_result_writer(env).write({"status": [{"idx": idx, "emp_id": emp_id, "status": "failed"}]})
+    record_case("failed", started)
+
+async def process_crc(env, case):
     idx, emp_id, initiated_on, name, pincode, dob, father_name, state, district, full_address = case
     fastapi_logger.info(f"""Processing case with following details
                 verify_id: {idx}
@@ -59,16 +73,18 @@ async def process_crc():
                 pincode: {pincode}
                 """)
 
+    started = time.perf_counter()
     try:
-        qb = QueryBuilder(env, name, father_name, pincode, state, district)
-        qb.get_query_list()
+        with time_stage("query_builder"):
+            qb = await run_blocking(env, QueryBuilder, env, name, father_name, pincode, state, district)
         fastapi_logger.info("Getting result from elastic search")
         print("Getting result from elastic search")
-        responses = await get_search(env, qb, size=500)
+        with time_stage("elasticsearch"):
+            hits = await get_search(env, qb, size=500)
         fastapi_logger.info("Elastic search query completed")
 
         fastapi_logger.info("Processing elastic response")
-        result = process_response(env, qb, responses)
+        result = await process_response(env, qb, hits)
         fastapi_logger.info("we do not have lat-lon for all police station and lot of time we dont have police station information")
         fastapi_logger.info("In above cases, we replace missing police station distance as twice the max distance")
         # check if results are empty
@@ -81,7 +97,8 @@ async def process_crc():
                     'case_state', 'case_district', 'case_court',
                     'case_stage', 'fir_police_station', 'act_section', 'order_exists',
                     'name_match', 'father_name_match' ,'percentage_father_in_name','father_in_name', 
-                    'police_station_distance', 'court_distance','in_same_district', 'in_same_state','modified_name_match' , ]
+                    'police_station_distance', 'court_distance','in_same_district', 'in_same_state','modified_name_match' , 
+                    'matched_queries', 'matched_query_count']
         result = result[cols_to_keep]
         fastapi_logger.info("Filtering the data based on some logic, this is subject to change")
         max_name_match = result.name_match.max()
@@ -108,32 +125,24 @@ async def process_crc():
         # fastapi_logger.info(f"CNRs found are", {result["cnr"]})
         fastapi_logger.info("Getting pre-signed URLs for case details and order copy")
         fastapi_logger.info("NOTE: pre-signed URLs are valid only for a week")
-        session = boto3.Session(aws_access_key_id=env['aws_access_key'], aws_secret_access_key=env['aws_secret'], region_name ='ap-south-1')
-        s3_client = session.client("s3", )
-        bucket_name = env['bucket']
-      
-        result[ 'case_details_url'] = result['cnr'].apply(lambda x: 
-            get_temporary_s3_url(s3_client, bucket_name, f'html_v1/{x}.html', 600000))
-        result['order_copy_details'] = result['cnr'].apply(lambda x: 
-            list_objects_with_key(s3_client,bucket_name, f"order_copy/{x}"))
-        result['order_copy_url'] = result['order_copy_details'].apply(lambda x: 
-            get_temporary_s3_url(s3_client, bucket_name, x, 600000) if x is not None else "")
+        with time_stage("s3_urls"):
+            result = await run_blocking(env, add_s3_urls, env, result.copy())
 
         # Separating Act-Section:
-        res = result.apply(lambda x: get_act_section(x['cnr'], x['case_details_url']), axis=1)
-        #check if act-section were extracted (if blank return series)
-        if all(r.empty for r in res):
+        with time_stage("act_sections"):
+            res_new = await get_act_sections(env, result)
+        #check if act-section were extracted
+        if res_new.empty:
             raise CaseStatusException("Act section not found", 204, "red")
         
-        res_new= pd.concat(list(res))
         result=pd.merge(res_new,result, how='left', left_on='cnr', right_on='cnr')
         result.drop_duplicates(inplace=True)
 
         # marking cases green or red:
         result.reset_index(inplace=True, drop=True)
         result["section"] = result['section'].apply(lambda x: [s.strip() for s in x.split(',')] if(pd.notnull(x)) else x)
-        result, green_failed = mark_green(env, result)
-        result, red_failed = mark_red(env, result)
+        with time_stage("ipc_marking"):
+            result = await run_blocking(env, mark_case_status, env, result)
         #mark petitioner cases as green
         result.loc[result["party_type"] == 'petitioner', "case_status"] = 'green'
         #check if cases were marked or not
@@ -148,13 +157,12 @@ async def process_crc():
 
 
         #TODO: of the court and police station from the candidate
-        result.drop(['police_station_distance', 'order_copy_details'], axis=1, inplace=True)
+        # matched_queries and matched_query_count are working columns, not part of the response
+        result.drop(['police_station_distance', 'order_copy_details', 'matched_queries', 'matched_query_count'], axis=1, inplace=True)
         result.sort_values("name_match", ascending=False, inplace=True)
         
         # result_json = json.dumps(result.to_dict(orient="list"))
-        result_json = result.to_json(orient="records")
-        query_status = f"insert into {env['cnr_request_status']} (idx, emp_id, status) values ('{idx}', '{emp_id}', 'completed')"
-        query_result = f"insert into {env['cnr_request_result']} (idx, result) values ('{idx}', '{result_json}')"
+        result_records = build_records(result)
 
         #inserting case status to a new table
         case_result = 'red' if 'red' in result["case_status"].values else 'green'
@@ -163,7 +171,7 @@ async def process_crc():
         #get court names for green case
         if case_result == 'green':
             # cnr_part_list = tuple(set(result["cnr"].str[:6].to_list()))
-            court_names = get_court_names(env, district=district, state=state)
+            court_names = await run_blocking(env, get_court_names, env, district, state)
         else:
             court_names = []
 
@@ -172,45 +180,33 @@ async def process_crc():
         response = json_response_builder(args)
 
         completed_on = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        #build write query to store the response
-        report_table = env['cnr_request_report']
-        args = emp_id, idx, initiated_on, completed_on, case_result, case_status_code, response, report_table
-        query_case_result = write_final_response(args)
-
-        ## Trying new method to insert the data
-        metadata = MetaData()
+        #build the rows to store the response
+        args = emp_id, idx, initiated_on, completed_on, case_result, case_status_code, response
+        status_row = {"idx": idx, "emp_id": emp_id, "status": "completed"}
         #TODO: add time stamp to the result table, req for re-generating the URLs
-        result_table = Table(env['cnr_request_result'], metadata, 
-                             Column('idx', String, primary_key=True),
-                             Column('result', JSON)
-                             )
-        query_result = result_table.insert().values(idx=idx, result=result_json)
         #TODO: take the POST endpoint from the env, and update the status for engineering team
         #TODO: above will be based on the environment
         fastapi_logger.info("Inserting result and updating status")
+        writer = get_result_writer(env)
         if not result.empty:
             fastapi_logger.info("Result is not empty")
-            engine = create_engine(env['db_string'])
-            with engine.connect() as connect:
-                connect.execute(query_result)
-                connect.execute(text(query_status))
-                connect.execute(query_case_result)
-                connect.commit()
-            notify_status_code = call_notify_api(env, idx)
-            fastapi_logger.info(f"Notify api status code: {notify_status_code}")
+            with time_stage("db_write"):
+                await writer.write({"result": [{"idx": idx, "result": result_records}], 
+                                    "status": [status_row], 
+                                    "report": [build_report_row(args)], 
+                                    "outbox": get_outbox_rows(env, idx)})
+            await notify(env, idx)
         else:
             fastapi_logger.info("Result is empty")
-            engine = create_engine(env['db_string'])
-            with engine.connect() as connect:
-                connect.execute(text(query_status))
-                connect.commit()
+            with time_stage("db_write"):
+                await writer.write({"status": [status_row]})
+        record_case(case_status_code, started)
     except CaseStatusException as e:
         fastapi_logger.info(f"Case status exception raised for verify id {idx}")
         fastapi_logger.info(f"status_code: {e.status_code} and case_status: {e.case_status}")
-        engine = create_engine(env['db_string'])
         #get court names for green case
         if str(e.case_status) == 'green':
-            court_names = get_court_names(env, district=district, state=state)
+            court_names = await run_blocking(env, get_court_names, env, district, state)
         else:
             court_names = []
         #build final json reponse
@@ -218,46 +214,170 @@ async def process_crc():
         response = json_response_builder(args)
 
         completed_on = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        #build write query to store the response
-        report_table = env['cnr_request_report']
-        args = emp_id, idx, initiated_on, completed_on, e.case_status, e.status_code, response, report_table
-        query_case_result = write_final_response(args)
-        query_status = f"insert into {env['cnr_request_status']} (idx, emp_id, status) values ('{idx}', '{emp_id}', 'completed')"
-        with engine.connect() as connect:
-            connect.execute(query_case_result)
-            connect.execute(text(query_status))
-            connect.commit()
-        notify_status_code = call_notify_api(env, idx)
-        fastapi_logger.info(f"Notify api status code: {notify_status_code}")
+        #build the rows to store the response
+        args = emp_id, idx, initiated_on, completed_on, e.case_status, e.status_code, response
+        try:
+            with time_stage("db_write"):
+                await get_result_writer(env).write({"report": [build_report_row(args)], 
+                                                    "status": [{"idx": idx, "emp_id": emp_id, "status": "completed"}], 
+                                                    "outbox": get_outbox_rows(env, idx)})
+        except Exception as write_error:
+            # the case still needs a status row, otherwise it is never picked up again
+            fastapi_logger.info(f"Failed to store the result for verify id: {idx}, {write_error}")
+            await write_failed_status(env, idx, emp_id, started)
+        else:
+            await notify(env, idx)
+            record_case(e.status_code, started)
     except Exception as e:
         fastapi_logger.info(f"Failed for verify id: {idx}")
         fastapi_logger.info(f"Failed reason: {e}")
-        engine = create_engine(env['db_string'])
-        query_status = f"insert into {env['cnr_request_status']} (idx, emp_id, status) values ('{idx}', '{emp_id}', 'failed')"
-        with engine.connect() as connect:
-            connect.execute(text(query_status))
-            connect.commit()
+        await write_failed_status(env, idx, emp_id, started)
     fastapi_logger.info(f"Completed for verify id {idx}")
 
-# @aiocron.crontab('*/1 * * * *')
-# async def cronjob_process():
-#     loop = asyncio.get_event_loop()
-#     coroutine = process_crc()
-#     loop.run_until_complete(coroutine)
-#     # asyncio.create_task(process_crc)
+async def install_worker_tables(env):
+    # runs before the worker claims anything. The trigger and the jsonb migration
+    # only speed things up, but cases can not be written without the outbox
+    if env['queue_listen']:
+        try:
+            await run_blocking(env, install_queue_trigger, env)
+        except Exception as e:
+            fastapi_logger.info(f"Unable to install the queue trigger: {e}")
+    if env['result_jsonb_migrate']:
+        try:
+            await run_blocking(env, install_jsonb_columns, env)
+        except Exception as e:
+            fastapi_logger.info(f"Unable to migrate the result columns to jsonb: {e}")
+    if env['notify_outbox']:
+        await run_blocking(env, install_notify_outbox, env)
 
-scheduler.add_job(process_crc, "interval", seconds=10, max_instances=3)
-scheduler.start()
+async def run_worker():
+    fastapi_logger.info("Getting environment variable")
+    env = get_env()
+    concurrency = env['worker_concurrency']
+    # task -> claimed case, so cases still running at shutdown can be requeued
+    in_flight = {}
+    listener = QueueListener(env) if env['queue_listen'] else None
+    dispatcher_task = None
+    if env['notify_outbox']:
+        dispatcher_task = asyncio.create_task(get_notify_dispatcher(env).run())
+
+    def on_case_done(task):
+        in_flight.pop(task, None)
+        cases_in_flight.set(len(in_flight))
+        if not task.cancelled() and task.exception() is not None:
+            fastapi_logger.info(f"Case processing crashed: {task.exception()}")
+
+    try:
+        while True:
+            # backpressure, never claim more cases than there are free slots
+            if len(in_flight) >= concurrency:
+                await asyncio.wait(list(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                continue
+            fastapi_logger.info("Getting cases from the queue")
+            try:
+                cases = await get_cases_async(env, min(env['worker_batch_size'], concurrency - len(in_flight)))
+            except Exception as e:
+                fastapi_logger.info(f"Failed to read the queue: {e}")
+                cases = []
+            if len(cases) == 0:
+                # only wait for the poll interval once the queue is drained
+                fastapi_logger.info("There are no cases to be processed")
+                if listener is not None:
+                    await listener.wait(env['queue_fallback_poll_interval'])
+                else:
+                    await asyncio.sleep(env['poll_interval'])
+                continue
+            fastapi_logger.info(f"There are cases to be processed, claimed {len(cases)}")
+            for case in cases:
+                task = asyncio.create_task(process_crc(env, case))
+                in_flight[task] = case
+                cases_in_flight.set(len(in_flight))
+                task.add_done_callback(on_case_done)
+    finally:
+        if listener is not None:
+            listener.stop()
+        # no more claims, the claimed cases get shutdown_grace seconds to finish while
+        # the clients are still open, the rest are cancelled and put back on the queue
+        if in_flight:
+            fastapi_logger.info(f"Waiting for {len(in_flight)} cases to finish")
+            _, pending = await asyncio.wait(list(in_flight), timeout=env['shutdown_grace'])
+            if pending:
+                cases = [in_flight[task] for task in pending]
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                await close_result_writer()
+                try:
+                    await requeue_cases(env, cases)
+                    fastapi_logger.info(f"Requeued {len(cases)} unfinished cases")
+                except Exception as e:
+                    fastapi_logger.info(f"Failed to requeue {len(cases)} unfinished cases: {e}")
+        if dispatcher_task is not None:
+            dispatcher_task.cancel()
+
+async def refresh_order_copy_index(env):
+    order_index = get_order_copy_index(env)
+    s3_client = get_s3_client(env)
+    while True:
+        try:
+            await run_blocking(env, order_index.refresh, s3_client, env['bucket'], env['order_index_inventory'])
+        except Exception as e:
+            fastapi_logger.info(f"Failed to build the order copy index: {e}")
+        await asyncio.sleep(env['order_index_refresh_interval'])
+
+async def refresh_reference_tables(env):
+    # reference tables are loaded before the worker starts and swapped in the background
+    while True:
+        await asyncio.sleep(env['reference_refresh_interval'])
+        try:
+            await run_blocking(env, refresh_reference_data, env)
+        except Exception as e:
+            fastapi_logger.info(f"Failed to refresh the reference tables: {e}")
+
+@app.on_event("startup")
+async def startup():
+    env = get_env()
+    await install_worker_tables(env)
+    # cases read the pincode table and court catalogue on the event loop, so
+    # they have to be loaded before the first case is claimed
+    await run_blocking(env, refresh_reference_data, env)
+    get_es_client(env)
+    background_tasks.append(asyncio.create_task(refresh_reference_tables(env)))
+    background_tasks.append(asyncio.create_task(run_worker()))
+    if env['order_index_enabled']:
+        background_tasks.append(asyncio.create_task(refresh_order_copy_index(env)))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    # run_worker drains its cases before the clients below are closed
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_es_client()
+    await close_http_session()
+    await close_result_writer()
+    await close_notify_session()
+    await close_async_engine()
+    shutdown_executors()
 
 @app.get("/")
 async def index():
     return JSONResponse(content={"message": "crc worker is up and running"})
 
+@app.get("/metrics")
+async def metrics():
+    env = get_env()
+    try:
+        queue_depth.set(await get_queue_depth(env))
+    except Exception as e:
+        fastapi_logger.info(f"Unable to read the queue depth: {e}")
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def main():
+    env = get_env()
+    await install_worker_tables(env)
+    await run_blocking(env, refresh_reference_data, env)
+    await run_worker()
+
 if __name__ == "__main__":
-    while 1:
-        loop = asyncio.get_event_loop()
-        coroutine = process_crc()
-        loop.run_until_complete(coroutine)
-    
-        
-    
+    asyncio.run(main())
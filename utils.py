@@ -1,15 +1,25 @@
 from dotenv import load_dotenv
 import os
 import pandas as pd
-import json
 # import googlemaps
 import numpy as np
-from sqlalchemy import create_engine, text, Table, Column, Integer, JSON, String, DateTime, MetaData
+from sqlalchemy import create_engine, text, bindparam, make_url, Table, Column, Integer, BigInteger, String, DateTime, MetaData
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.dialects.postgresql import JSONB
+import orjson
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import asyncio
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import boto3
 from botocore.config import Config
 from pathlib import Path
 import logging
-import requests
+from functools import partial
+from collections.abc import Iterable
+from cache_utils import TtlCache, IpcRuleIndex, PincodeTable, CourtCatalogue
+from cache_utils import get_order_copy_index, get_presigned_url_cache
 
 BASE_DIR = Path(__file__).parent.parent.absolute()
 
@@ -43,6 +53,90 @@ def get_env():
     ##notify api details
     notify_url = os.environ.get("notify_url")
     notify_token = os.environ.get("notify_token")
+    # opt in, the worker refuses to start when the outbox table can not be created
+    notify_outbox = os.environ.get("NOTIFY_OUTBOX", "false").lower() == "true"
+    notify_outbox_table = os.environ.get("NOTIFY_OUTBOX_TABLE", "cnr_notify_outbox")
+    notify_concurrency = int(os.environ.get("NOTIFY_CONCURRENCY", 8))
+    notify_timeout = float(os.environ.get("NOTIFY_TIMEOUT", 10))
+    # retries with backoff are only done by the outbox dispatcher, direct delivery tries once
+    notify_max_attempts = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 8))
+    notify_backoff = float(os.environ.get("NOTIFY_BACKOFF", 2))
+    notify_backoff_max = float(os.environ.get("NOTIFY_BACKOFF_MAX", 300))
+    notify_batch_size = int(os.environ.get("NOTIFY_BATCH_SIZE", 1))
+    notify_poll_interval = float(os.environ.get("NOTIFY_POLL_INTERVAL", 5))
+    # sent and exhausted outbox rows are deleted once they are older than the retention
+    notify_retention = float(os.environ.get("NOTIFY_RETENTION", 604800))
+    notify_prune_interval = float(os.environ.get("NOTIFY_PRUNE_INTERVAL", 3600))
+
+    ## db connection pool settings
+    # with DB_ASYNC each process holds two pools, the asyncpg one sized by DB_POOL_SIZE
+    # and DB_MAX_OVERFLOW for the per case queries and a small sync one for startup,
+    # reference data and rule loads, plus the queue listener connection. At most
+    # DB_POOL_SIZE + DB_MAX_OVERFLOW + DB_SYNC_POOL_SIZE + DB_SYNC_MAX_OVERFLOW + 1
+    # connections per process. Without DB_ASYNC the sync pool takes the DB_POOL_* sizes
+    db_pool_size = int(os.environ.get("DB_POOL_SIZE", 5))
+    db_max_overflow = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+    db_pool_recycle = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+    db_async = os.environ.get("DB_ASYNC", "true").lower() == "true"
+    db_sync_pool_size = int(os.environ.get("DB_SYNC_POOL_SIZE", 2 if db_async else db_pool_size))
+    db_sync_max_overflow = int(os.environ.get("DB_SYNC_MAX_OVERFLOW", 1 if db_async else db_max_overflow))
+
+    ## elastic client settings
+    es_hosts = os.environ.get("ES_HOSTS")
+    es_connections_per_node = int(os.environ.get("ES_CONNECTIONS_PER_NODE", 10))
+    es_request_timeout = float(os.environ.get("ES_REQUEST_TIMEOUT", 100))
+    es_max_retries = int(os.environ.get("ES_MAX_RETRIES", 3))
+    es_use_msearch = os.environ.get("ES_USE_MSEARCH", "false").lower() == "true"
+    es_msearch_window = float(os.environ.get("ES_MSEARCH_WINDOW", 0.05))
+    es_paging = os.environ.get("ES_PAGING", "false").lower() == "true"
+    es_max_hits = int(os.environ.get("ES_MAX_HITS", 2000))
+    es_pit_keep_alive = os.environ.get("ES_PIT_KEEP_ALIVE", "1m")
+    es_geo_mode = os.environ.get("ES_GEO_MODE", "off").lower()
+    es_geo_field = os.environ.get("ES_GEO_FIELD", "court_location")
+    es_geo_distance_km = float(os.environ.get("ES_GEO_DISTANCE_KM", 100))
+
+    ## worker loop settings
+    worker_batch_size = int(os.environ.get("WORKER_BATCH_SIZE", 10))
+    worker_concurrency = int(os.environ.get("WORKER_CONCURRENCY", 3))
+    poll_interval = float(os.environ.get("POLL_INTERVAL", 10))
+    queue_listen = os.environ.get("QUEUE_LISTEN", "false").lower() == "true"
+    queue_channel = os.environ.get("QUEUE_CHANNEL", "cnr_request_new")
+    queue_fallback_poll_interval = float(os.environ.get("QUEUE_FALLBACK_POLL_INTERVAL", 60))
+    shutdown_grace = float(os.environ.get("SHUTDOWN_GRACE", 25))
+
+    ## case details html fetch settings
+    html_fetch_concurrency = int(os.environ.get("HTML_FETCH_CONCURRENCY", 20))
+    html_fetch_timeout = float(os.environ.get("HTML_FETCH_TIMEOUT", 30))
+    html_cache_enabled = os.environ.get("HTML_CACHE_ENABLED", "true").lower() == "true"
+    html_cache_dir = os.environ.get("HTML_CACHE_DIR", "/tmp/crc_html_cache")
+    html_cache_memory_items = int(os.environ.get("HTML_CACHE_MEMORY_ITEMS", 1000))
+    html_cache_disk_mb = int(os.environ.get("HTML_CACHE_DISK_MB", 512))
+    html_cache_ttl = float(os.environ.get("HTML_CACHE_TTL", 86400))
+    # HTML_CACHE_DISK_MB caps the directory as a whole, workers sharing it rescan it this often
+    html_cache_scan_interval = float(os.environ.get("HTML_CACHE_SCAN_INTERVAL", 60))
+
+    ## order copy key index settings
+    order_index_enabled = os.environ.get("ORDER_INDEX_ENABLED", "false").lower() == "true"
+    order_index_inventory = os.environ.get("ORDER_INDEX_INVENTORY")
+    order_index_refresh_interval = float(os.environ.get("ORDER_INDEX_REFRESH_INTERVAL", 3600))
+
+    ## s3 client and presigned url cache settings
+    s3_endpoint_url = os.environ.get("S3_ENDPOINT_URL")
+    s3_max_pool_connections = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 20))
+    presign_cache_size = int(os.environ.get("PRESIGN_CACHE_SIZE", 10000))
+    presign_cache_min_ttl = float(os.environ.get("PRESIGN_CACHE_MIN_TTL", 518400))
+
+    ## reference data refresh settings
+    ipc_rules_ttl = float(os.environ.get("IPC_RULES_TTL", 3600))
+    reference_refresh_interval = float(os.environ.get("REFERENCE_REFRESH_INTERVAL", 3600))
+
+    ## executor settings
+    fuzzy_workers = int(os.environ.get("FUZZY_WORKERS", 1))
+    result_batch_size = int(os.environ.get("RESULT_BATCH_SIZE", 50))
+    result_flush_interval = float(os.environ.get("RESULT_FLUSH_INTERVAL", 0.2))
+    result_jsonb_migrate = os.environ.get("RESULT_JSONB_MIGRATE", "false").lower() == "true"
+    io_workers = int(os.environ.get("IO_WORKERS", 16))
+    cpu_workers = int(os.environ.get("CPU_WORKERS", 0))
     
     return {
         "cloud_id" : cloud_id, 
@@ -63,11 +157,193 @@ def get_env():
         "cnr_request_report": cnr_request_report, 
         "cnr_request_result": cnr_request_result,
         "notify_url": notify_url,
-        "notify_token": notify_token
+        "notify_token": notify_token,
+        "notify_outbox": notify_outbox,
+        "notify_outbox_table": notify_outbox_table,
+        "notify_concurrency": notify_concurrency,
+        "notify_timeout": notify_timeout,
+        "notify_max_attempts": notify_max_attempts,
+        "notify_backoff": notify_backoff,
+        "notify_backoff_max": notify_backoff_max,
+        "notify_batch_size": notify_batch_size,
+        "notify_poll_interval": notify_poll_interval,
+        "notify_retention": notify_retention,
+        "notify_prune_interval": notify_prune_interval,
+        "db_pool_size": db_pool_size,
+        "db_max_overflow": db_max_overflow,
+        "db_pool_recycle": db_pool_recycle,
+        "db_async": db_async,
+        "db_sync_pool_size": db_sync_pool_size,
+        "db_sync_max_overflow": db_sync_max_overflow,
+        "es_hosts": es_hosts,
+        "es_connections_per_node": es_connections_per_node,
+        "es_request_timeout": es_request_timeout,
+        "es_max_retries": es_max_retries,
+        "es_use_msearch": es_use_msearch,
+        "es_msearch_window": es_msearch_window,
+        "es_paging": es_paging,
+        "es_max_hits": es_max_hits,
+        "es_pit_keep_alive": es_pit_keep_alive,
+        "es_geo_mode": es_geo_mode,
+        "es_geo_field": es_geo_field,
+        "es_geo_distance_km": es_geo_distance_km,
+        "worker_batch_size": worker_batch_size,
+        "worker_concurrency": worker_concurrency,
+        "poll_interval": poll_interval,
+        "queue_listen": queue_listen,
+        "queue_channel": queue_channel,
+        "queue_fallback_poll_interval": queue_fallback_poll_interval,
+        "shutdown_grace": shutdown_grace,
+        "html_fetch_concurrency": html_fetch_concurrency,
+        "html_fetch_timeout": html_fetch_timeout,
+        "html_cache_enabled": html_cache_enabled,
+        "html_cache_dir": html_cache_dir,
+        "html_cache_memory_items": html_cache_memory_items,
+        "html_cache_disk_mb": html_cache_disk_mb,
+        "html_cache_ttl": html_cache_ttl,
+        "html_cache_scan_interval": html_cache_scan_interval,
+        "order_index_enabled": order_index_enabled,
+        "order_index_inventory": order_index_inventory,
+        "order_index_refresh_interval": order_index_refresh_interval,
+        "s3_endpoint_url": s3_endpoint_url,
+        "s3_max_pool_connections": s3_max_pool_connections,
+        "presign_cache_size": presign_cache_size,
+        "presign_cache_min_ttl": presign_cache_min_ttl,
+        "ipc_rules_ttl": ipc_rules_ttl,
+        "reference_refresh_interval": reference_refresh_interval,
+        "fuzzy_workers": fuzzy_workers,
+        "result_batch_size": result_batch_size,
+        "result_flush_interval": result_flush_interval,
+        "result_jsonb_migrate": result_jsonb_migrate,
+        "io_workers": io_workers,
+        "cpu_workers": cpu_workers
             }
     
     
 
+_io_executor = None
+_cpu_executor = None
+
+def get_io_executor(env):
+    # bounded thread pool for the blocking db, s3 and http calls
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=env['io_workers'], thread_name_prefix="crc-io")
+    return _io_executor
+
+def get_cpu_executor(env):
+    # optional process pool for the cpu heavy stages, falls back to the thread pool
+    global _cpu_executor
+    if env['cpu_workers'] <= 0:
+        return get_io_executor(env)
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=env['cpu_workers'], mp_context=multiprocessing.get_context("spawn"))
+    return _cpu_executor
+
+async def run_blocking(env, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(get_io_executor(env), partial(func, *args))
+
+async def run_cpu(env, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_executor(env), partial(func, *args))
+
+def shutdown_executors():
+    global _io_executor, _cpu_executor
+    for executor in (_io_executor, _cpu_executor):
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+    _io_executor = None
+    _cpu_executor = None
+
+def dumps_json(obj):
+    # used by both engines for the JSON/JSONB columns, nan is written as null like to_json
+    return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+
+def build_records(df):
+    # records straight from the column lists, tolist() already returns python scalars
+    columns = df.columns.tolist()
+    return [dict(zip(columns, row)) for row in zip(*[df[column].tolist() for column in columns])]
+
+_engine = None
+
+def get_engine(env):
+    # one pooled engine per worker process, shared by every stage of the pipeline
+    global _engine
+    if _engine is None:
+        _engine = create_engine(env['db_string'],
+                                pool_size=env['db_sync_pool_size'],
+                                max_overflow=env['db_sync_max_overflow'],
+                                pool_recycle=env['db_pool_recycle'],
+                                pool_pre_ping=True,
+                                json_serializer=dumps_json)
+    return _engine
+
+_async_engine = None
+
+# libpq parameters asyncpg reads from a dsn itself, application_name and options
+# are sent to the server as startup settings
+ASYNCPG_DSN_PARAMS = {"host", "port", "dbname", "database", "user", "password", "passfile", "service",
+                      "sslmode", "sslcert", "sslkey", "sslrootcert", "sslcrl", "sslpassword", "sslnegotiation",
+                      "ssl_min_protocol_version", "ssl_max_protocol_version", "target_session_attrs",
+                      "krbsrvname", "gsslib", "application_name", "options"}
+
+def get_asyncpg_connect_args(db_string):
+    # asyncpg parses the libpq dsn on its own, so sslmode and the ssl files keep their
+    # libpq meaning. connect_timeout becomes asyncpg's timeout, other libpq only
+    # parameters (keepalives, gssencmode, ...) would be sent as server settings and
+    # fail every connect, so they are dropped
+    url = make_url(db_string).set(drivername="postgresql")
+    query = {}
+    connect_args = {}
+    for key, value in url.query.items():
+        if key == "connect_timeout":
+            connect_args["timeout"] = float(value)
+        elif key in ASYNCPG_DSN_PARAMS:
+            query[key] = value
+        else:
+            logging.info(f"Ignoring the {key} parameter of DB_STRING for the async engine")
+    connect_args["dsn"] = url.set(query=query).render_as_string(hide_password=False)
+    return connect_args
+
+def get_async_engine(env):
+    # asyncpg backed engine for the per case queries, cases wait on the pool
+    # instead of holding an executor thread each
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = create_async_engine("postgresql+asyncpg://",
+                                            connect_args=get_asyncpg_connect_args(env['db_string']),
+                                            pool_size=env['db_pool_size'],
+                                            max_overflow=env['db_max_overflow'],
+                                            pool_recycle=env['db_pool_recycle'],
+                                            pool_pre_ping=True,
+                                            json_serializer=dumps_json)
+    return _async_engine
+
+async def close_async_engine():
+    global _async_engine
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+
+async def fetch_rows(env, query, params=None, commit=False):
+    if not env['db_async']:
+        return await run_blocking(env, fetch_rows_sync, env, query, params, commit)
+    engine = get_async_engine(env)
+    async with engine.connect() as connect:
+        res = await connect.execute(text(query) if isinstance(query, str) else query, params or {})
+        rows = res.fetchall() if res.returns_rows else []
+        if commit:
+            await connect.commit()
+        return rows
+
+def fetch_rows_sync(env, query, params=None, commit=False):
+    engine = get_engine(env)
+    with engine.connect() as connect:
+        res = connect.execute(text(query) if isinstance(query, str) else query, params or {})
+        rows = res.fetchall() if res.returns_rows else []
+        if commit:
+            connect.commit()
+        return rows
+
 def get_geocode(args):
     gmaps, idx, text = args
     geocode_result = gmaps.geocode(text)
@@ -113,58 +389,330 @@ def haversine_vectorize(lon1, lat1, lon2, lat2):
     km = 6367 * dist
     return km
 
-def get_case(env):
-    db_string = env['db_string']
-    engine = create_engine(db_string)
-    query_idx = f"""delete from {env['cnr_request_status']} cr using 
-                      (select * from {env['cnr_request_status']} where status = 'in_progress' limit 1
+def get_case_queries(env):
+    query_idx = text(f"""delete from {env['cnr_request_status']} cr using 
+                      (select * from {env['cnr_request_status']} where status = 'in_progress' limit :limit
                       for update skip locked) crs
-                      where cr.idx = crs.idx returning crs.idx"""
+                      where cr.idx = crs.idx returning crs.idx""")
+    query_details = text(f"""select * from {env['cnr_request_queue']} where idx in :idx_list""").bindparams(
+        bindparam('idx_list', expanding=True))
+    return query_idx, query_details
+
+def get_cases(env, limit=1):
+    # claims up to `limit` queued cases in a single round trip
+    engine = get_engine(env)
+    query_idx, query_details = get_case_queries(env)
                     
     with engine.connect() as connect:
-        idx = connect.execute(text(query_idx)).fetchall()
+        idx = connect.execute(query_idx, {"limit": limit}).fetchall()
         if len(idx) > 0:
-            idx = idx[0][0]
-            query_details = f"""select * from {env['cnr_request_queue']} where idx = '{idx}'"""
-            case_details = connect.execute(text(query_details)).fetchall()
+            idx_list = [i[0] for i in idx]
+            case_details = connect.execute(query_details, {"idx_list": idx_list}).fetchall()
             connect.commit()
         else:
             case_details = []
     return case_details
 
-def get_court_names(env, district, state):
-    db_string = env['db_string']
-    engine = create_engine(db_string)
-    court_district_query = f"""select distinct court_name, state_code_num from court_data cd 
-                            WHERE state ilike '{state}' and district ilike '{district}' 
-                            limit 15;"""
-    
-    court_state_query = f"""select distinct court_name, state_code_num from court_data cd 
-                            WHERE state ilike '{state}'
-                            limit 15;"""
+async def get_cases_async(env, limit=1):
+    # get_cases on the async engine, the claim and the read share one transaction
+    if not env['db_async']:
+        return await run_blocking(env, get_cases, env, limit)
+    engine = get_async_engine(env)
+    query_idx, query_details = get_case_queries(env)
 
+    async with engine.connect() as connect:
+        idx = (await connect.execute(query_idx, {"limit": limit})).fetchall()
+        if len(idx) > 0:
+            idx_list = [i[0] for i in idx]
+            case_details = (await connect.execute(query_details, {"idx_list": idx_list})).fetchall()
+            await connect.commit()
+        else:
+            case_details = []
+    return case_details
 
+async def requeue_cases(env, cases):
+    # puts claimed cases back as in_progress unless they already got a status row
+    query_requeue = f"""insert into {env['cnr_request_status']} (idx, emp_id, status) 
+                        select cast(:idx as text), cast(:emp_id as text), 'in_progress'
+                        where not exists (select 1 from {env['cnr_request_status']} where idx = :idx)"""
+    await fetch_rows(env, query_requeue, [{"idx": case[0], "emp_id": case[1]} for case in cases], commit=True)
+
+async def get_queue_depth(env):
+    query_depth = f"""select count(*) from {env['cnr_request_status']} where status = 'in_progress'"""
+    rows = await fetch_rows(env, query_depth)
+    return rows[0][0]
+
+def install_queue_trigger(env):
+    # notify the queue channel whenever a case is queued as in_progress, an empty
+    # payload lets postgres collapse a bulk upload into a single notification
+    channel = env['queue_channel']
+    query_function = f"""create or replace function {channel}_notify() returns trigger as $$
+                         begin
+                            perform pg_notify('{channel}', '');
+                            return null;
+                         end;
+                         $$ language plpgsql;"""
+    query_drop_trigger = f"""drop trigger if exists {channel}_trigger on {env['cnr_request_status']};"""
+    query_trigger = f"""create trigger {channel}_trigger after insert on {env['cnr_request_status']}
+                        for each row when (new.status = 'in_progress')
+                        execute function {channel}_notify();"""
+    query_exists = f"""select 1 from pg_trigger where tgname = '{channel}_trigger' and not tgisinternal
+                       and tgrelid = to_regclass('{env['cnr_request_status']}')"""
+    engine = get_engine(env)
     with engine.connect() as connect:
+        # the ddl takes an exclusive lock on the status table, skip it when another worker already did it
+        if connect.execute(text(query_exists)).first() is not None:
+            return
+        connect.execute(text(query_function))
+        connect.execute(text(query_drop_trigger))
+        connect.execute(text(query_trigger))
+        connect.commit()
+
+class QueueListener:
+    # LISTENs on the queue channel over a dedicated connection and wakes the worker up
+    
+    def __init__(self, env):
+        self.env = env
+        self.event = asyncio.Event()
+        self.connection = None
+        self.fd = None
+
+    def connect(self):
+        dsn = make_url(self.env['db_string']).set(drivername="postgresql").render_as_string(hide_password=False)
+        connection = psycopg2.connect(dsn)
+        connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.env['queue_channel']};")
+        return connection
+
+    async def start(self):
+        # connecting blocks, so it runs on the io executor
+        self.connection = await run_blocking(self.env, self.connect)
+        self.fd = self.connection.fileno()
+        asyncio.get_running_loop().add_reader(self.fd, self.on_notify)
+
+    def stop(self):
+        # the reader is removed by the fd it was added with, a dead connection may not report it
+        if self.fd is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.fd)
+            except Exception:
+                pass
+            self.fd = None
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def on_notify(self):
+        try:
+            self.connection.poll()
+        except psycopg2.Error as e:
+            logging.info(f"Queue listener connection lost {e}")
+            self.stop()
+            self.event.set()
+            return
+        if self.connection.notifies:
+            self.connection.notifies.clear()
+            self.event.set()
+
+    async def wait(self, timeout):
+        # reconnect lazily, until then this degrades to the fallback poll
+        if self.connection is None:
+            try:
+                await self.start()
+            except Exception as e:
+                logging.info(f"Unable to listen on the queue channel {e}")
         try:
-            #first priority on to query court names based on state and district
-            court_names_district = connect.execute(text(court_district_query)).fetchall()
-            if len(court_names_district) > 0:
-                court_names = [f"{court_name}" for court_name, st in court_names_district]
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.event.clear()
+
+_metadata = MetaData()
+
+def get_result_table(name):
+    # table objects are defined once per process and shared by every case
+    if name not in _metadata.tables:
+        Table(name, _metadata, 
+              Column('idx', String, primary_key=True),
+              Column('result', JSONB))
+    return _metadata.tables[name]
+
+def get_status_table(name):
+    if name not in _metadata.tables:
+        Table(name, _metadata, 
+              Column('idx', String),
+              Column('emp_id', String),
+              Column('status', String))
+    return _metadata.tables[name]
+
+def get_report_table(name):
+    if name not in _metadata.tables:
+        Table(name, _metadata, 
+              Column('idx', String, primary_key=True),
+              Column('emp_id', String),
+              Column('initiated_on', DateTime),
+              Column('completed_on', DateTime),
+              Column('case_status', String),
+              Column('status_code', Integer),
+              Column('report', JSONB))
+    return _metadata.tables[name]
+
+def get_outbox_table(name):
+    # only idx is written by the cases, the delivery columns are owned by the notify dispatcher
+    if name not in _metadata.tables:
+        Table(name, _metadata, 
+              Column('id', BigInteger, primary_key=True),
+              Column('idx', String))
+    return _metadata.tables[name]
+
+def install_jsonb_columns(env):
+    # one off migration of the result and report columns to jsonb. Rows written before
+    # this were stored as json encoded strings and are decoded on the way
+    for table, column in [(env['cnr_request_result'], 'result'), (env['cnr_request_report'], 'report')]:
+        query_alter = f"""alter table {table} alter column {column} type jsonb using 
+                          case when json_typeof({column}::json) = 'string' then ({column}::json #>> '{{}}')::jsonb 
+                          else {column}::jsonb end"""
+        # a schema qualified name is checked in that schema, an unqualified one in current_schema()
+        schema, _, table_name = table.rpartition('.')
+        query_type = text("""select data_type from information_schema.columns 
+                             where table_schema = coalesce(:schema, current_schema()) 
+                             and table_name = :table and column_name = :column""")
+        engine = get_engine(env)
+        with engine.connect() as connect:
+            data_type = connect.execute(query_type, {"schema": schema or None, "table": table_name, "column": column}).scalar()
+            if data_type != 'jsonb':
+                connect.execute(text(query_alter))
                 connect.commit()
-            #if no courts based on district(or district is empty), then query court names based on state
-            elif len(court_names_district) == 0:
-                court_names_state = connect.execute(text(court_state_query)).fetchall()
-                if len(court_names_state) > 0:
-                    court_names = [f"{court_name}" for court_name, st in court_names_state]
-                    connect.commit()
-                else:
-                    court_names = []
-        except:
-            court_names = []
 
+def get_case_inserts(env, cases):
+    # cases are dicts of result/status/report rows, every table gets one multi row
+    # insert in the order a single case used to be written
+    tables = [("result", get_result_table(env['cnr_request_result'])), 
+              ("status", get_status_table(env['cnr_request_status'])), 
+              ("report", get_report_table(env['cnr_request_report'])), 
+              ("outbox", get_outbox_table(env['notify_outbox_table']))]
+    inserts = []
+    for key, table in tables:
+        rows = [row for case in cases for row in case.get(key, [])]
+        if rows:
+            inserts.append((table.insert(), rows))
+    return inserts
+
+def persist_cases_sync(env, cases):
+    engine = get_engine(env)
+    with engine.connect() as connect:
+        for query, rows in get_case_inserts(env, cases):
+            connect.execute(query, rows)
+        connect.commit()
+
+async def persist_cases(env, cases):
+    # writes a batch of finished cases in a single transaction
+    if not env['db_async']:
+        return await run_blocking(env, persist_cases_sync, env, cases)
+    engine = get_async_engine(env)
+    async with engine.connect() as connect:
+        for query, rows in get_case_inserts(env, cases):
+            await connect.execute(query, rows)
+        await connect.commit()
+
+class ResultWriter:
+    # buffers finished cases and flushes them once result_batch_size cases are
+    # waiting or the oldest has waited result_flush_interval seconds. write()
+    # returns only after the case is committed, so notify still follows the insert
+    
+    def __init__(self, env):
+        self.env = env
+        self.pending = []
+        self.flush_timer = None
+        self.flushes = set()
+
+    async def write(self, case):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((case, future))
+        if len(self.pending) >= self.env['result_batch_size']:
+            self.start_flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.get_running_loop().call_later(self.env['result_flush_interval'], self.start_flush)
+        await asyncio.shield(future)
+
+    def start_flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.flush(batch))
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+
+    async def flush(self, batch):
+        try:
+            await persist_cases(self.env, [case for case, _ in batch])
+            results = [None] * len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                # one bad case must not fail the whole batch, retry them one by one
+                logging.info(f"Batch insert of {len(batch)} cases failed, writing them one by one: {e}")
+                results = await asyncio.gather(*[persist_cases(self.env, [case]) for case, _ in batch], 
+                                               return_exceptions=True)
+        for (_, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def close(self):
+        self.start_flush()
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+_result_writer = None
+
+def get_result_writer(env):
+    global _result_writer
+    if _result_writer is None:
+        _result_writer = ResultWriter(env)
+    return _result_writer
+
+async def close_result_writer():
+    global _result_writer
+    if _result_writer is not None:
+        await _result_writer.close()
+        _result_writer = None
+
+def get_court_names(env, district, state):
+    try:
+        court_names = get_court_catalogue(env).get_court_names(district, state)
+    except Exception as e:
+        logging.info(f"Unable to get court names {e}")
+        court_names = []
     return court_names
 
-def get_temporary_s3_url(s3_client, bucket_name, object_key, expiration=600000):
+_s3_client = None
+
+def get_s3_client(env):
+    # boto3 clients are thread safe, so one per process avoids re-resolving
+    # credentials and endpoints for every case
+    global _s3_client
+    if _s3_client is None:
+        session = boto3.Session(aws_access_key_id=env['aws_access_key'], aws_secret_access_key=env['aws_secret'], region_name ='ap-south-1')
+        _s3_client = session.client("s3", endpoint_url=env['s3_endpoint_url'], 
+                                    config=Config(max_pool_connections=env['s3_max_pool_connections']))
+    return _s3_client
+
+def get_temporary_s3_url(s3_client, bucket_name, object_key, expiration=600000, url_cache=None):
+    if url_cache is not None:
+        url = url_cache.get(bucket_name, object_key)
+        if url is not None:
+            return url
     try:
         response = s3_client.generate_presigned_url(
             "get_object",
@@ -174,6 +722,8 @@ def get_temporary_s3_url(s3_client, bucket_name, object_key, expiration=600000):
     except Exception as e:
         logging.info(f"Error generating temporary URL {e}")
         return None
+    if url_cache is not None:
+        url_cache.put(bucket_name, object_key, response, expiration)
     return response
 
 def list_objects_with_key(s3_client, bucket_name, prefix):
@@ -190,73 +740,113 @@ def list_objects_with_key(s3_client, bucket_name, prefix):
         return objects[0]
     return None
     
-def mark_green(env, df):
-    db_string = env['db_string']
-    engine = create_engine(db_string)
-    query_ipc = f"""SELECT type, code FROM court_ipc_green;"""
-    ipc_cols = ['TYPE', 'CODE']
+def add_s3_urls(env, result):
+    # presigned case details and order copy urls for every matched cnr
+    s3_client = get_s3_client(env)
+    url_cache = get_presigned_url_cache(env)
+    bucket_name = env['bucket']
+  
+    result[ 'case_details_url'] = result['cnr'].apply(lambda x: 
+        get_temporary_s3_url(s3_client, bucket_name, f'html_v1/{x}.html', 600000, url_cache))
+    order_index = get_order_copy_index(env)
+    # the refresh loop rebuilds it every interval, allow one slow rebuild before falling back
+    max_age = 2 * env['order_index_refresh_interval']
+    result['order_copy_details'] = result['cnr'].apply(lambda x: 
+        find_order_copy(s3_client,bucket_name, f"order_copy/{x}", order_index, max_age))
+    # pandas turns the None of a cnr without an order copy into NaN once some cnrs have
+    # a key, so only real keys are presigned, the rest get an empty url
+    result['order_copy_url'] = result['order_copy_details'].apply(lambda x: 
+        get_temporary_s3_url(s3_client, bucket_name, x, 600000, url_cache) if isinstance(x, str) else "")
+    return result
+
+def find_order_copy(s3_client, bucket_name, prefix, order_index=None, max_age=None):
+    # a current index answers on its own, a miss there means there is no order copy.
+    # Live LIST only while the index is not built yet or has stopped refreshing
+    if order_index is not None and order_index.is_current(max_age):
+        return order_index.find(prefix)
+    return list_objects_with_key(s3_client, bucket_name, prefix)
+    
+def load_ipc_rule_index(env, table):
+    engine = get_engine(env)
+    query_ipc = f"""SELECT type, code FROM {table};"""
     with engine.connect() as connect:
         res = connect.execute(text(query_ipc)).fetchall()
-    ipc_dct = [dict(zip(ipc_cols, r)) for r in res]
-    green_report_df = pd.DataFrame(ipc_dct)
     # ipc_sheet_path = "IPC_reporting_list.xlsx"
-    # green_report_df = pd.read_excel(ipc_sheet_path, sheet_name='GREEN')
-    failed_cnr=[]
+    # report_df = pd.read_excel(ipc_sheet_path, sheet_name='GREEN')
+    return IpcRuleIndex(res)
 
-    for index,val in df.iterrows():
-        try:
-            if val['act'].lower().strip() in green_report_df['TYPE'].str.lower().str.strip().unique():
-                df_new=green_report_df.loc[(green_report_df['TYPE'].str.lower().str.strip()==val['act'].lower().strip()),:]
-                try:
-                    for ev in val["section"]:
-                        try:
-                            if int(ev) in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'green'
-                            elif ev in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'green'
-                        except:
-                            if ev in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'green'
-                except:
-                    failed_cnr.append(val['cnr'])
-        except:
-            failed_cnr.append(val['cnr'])
-    return df, failed_cnr
+_ipc_rule_indexes = {}
 
-def mark_red(env, df):
-    db_string = env['db_string']
-    engine = create_engine(db_string)
-    query_ipc = f"""SELECT type, code FROM court_ipc_red;"""
-    ipc_cols = ['TYPE', 'CODE']
+def get_ipc_rule_index(env, table):
+    # rules are loaded once per process and reloaded after ipc_rules_ttl seconds
+    if table not in _ipc_rule_indexes:
+        _ipc_rule_indexes[table] = TtlCache(partial(load_ipc_rule_index, env, table), env['ipc_rules_ttl'])
+    return _ipc_rule_indexes[table].get()
+
+def refresh_ipc_rules():
+    for rule_index in _ipc_rule_indexes.values():
+        rule_index.invalidate()
+
+def load_pincode_table(env):
+    engine = get_engine(env)
+    query_pincode = """select pincode, district, state, latitude, longitude from pincode;"""
     with engine.connect() as connect:
-        res = connect.execute(text(query_ipc)).fetchall()
-    ipc_dct = [dict(zip(ipc_cols, r)) for r in res]
-    red_report_df = pd.DataFrame(ipc_dct)
-    # ipc_sheet_path = "IPC_reporting_list.xlsx"
-    # red_report_df = pd.read_excel(ipc_sheet_path, sheet_name='RED')
-    failed_cnr=[]
+        res = connect.execute(text(query_pincode)).fetchall()
+    return PincodeTable(res)
 
-    for index,val in df.iterrows():
-        try:
-            if val['act'].lower().strip() in red_report_df['TYPE'].str.lower().str.strip().unique():
-                df_new=red_report_df.loc[(red_report_df['TYPE'].str.lower().str.strip()==val['act'].lower().strip()),:]
-                try:
-                    for ev in val["section"]:
-                        try:
-                            if int(ev) in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'red'
-                            elif ev in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'red'
-                        except:
-                            if ev in list(df_new['CODE']):
-                                df.loc[index, "case_status"] = 'red'
-                except:
-                    failed_cnr.append(val['cnr'])
-        except:
-            failed_cnr.append(val['cnr'])
+def load_court_catalogue(env):
+    engine = get_engine(env)
+    query_courts = """select distinct court_name, state_code_num, state, district from court_data;"""
+    query_locations = f"""select cnr_part, latitude, longitude from {env['court_pincode']};"""
+    with engine.connect() as connect:
+        courts = connect.execute(text(query_courts)).fetchall()
+        locations = connect.execute(text(query_locations)).fetchall()
+    return CourtCatalogue(courts, locations)
+
+_reference_tables = {}
+
+def get_reference_table(env, name, loader):
+    # loaded on first use, afterwards only replaced by refresh_reference_data
+    if name not in _reference_tables:
+        _reference_tables[name] = TtlCache(partial(loader, env), None)
+    return _reference_tables[name].get()
 
+def get_pincode_table(env):
+    return get_reference_table(env, "pincode", load_pincode_table)
+
+def get_court_catalogue(env):
+    return get_reference_table(env, "court_catalogue", load_court_catalogue)
+
+def refresh_reference_data(env):
+    for name, loader in [("pincode", load_pincode_table), ("court_catalogue", load_court_catalogue)]:
+        if name not in _reference_tables:
+            get_reference_table(env, name, loader)
+        else:
+            _reference_tables[name].refresh()
+
+def mark_cases(df, rule_index, case_status):
+    # one pass over the exploded act/section rows, a row is marked when any of its
+    # sections is in the rules for its act. Rows whose act is not text, or whose
+    # act has rules but the section can not be iterated, are reported as failed
+    act = df['act'].map(lambda x: x.lower().strip() if isinstance(x, str) else None)
+    failed_cnr = list(df.loc[act.isna(), 'cnr'])
+    has_rules = act.isin(rule_index.types)
+    sections = df.loc[has_rules, 'section']
+    is_iterable = sections.map(lambda x: isinstance(x, Iterable))
+    failed_cnr += list(df.loc[is_iterable[~is_iterable].index, 'cnr'])
+    exploded = sections[is_iterable].explode().dropna()
+    matched = [rule_index.match(a, ev) for a, ev in zip(act[exploded.index], exploded.values)]
+    marked = exploded.index[matched].unique()
+    if len(marked) > 0:
+        df.loc[marked, "case_status"] = case_status
     return df, failed_cnr
 
+def mark_green(env, df):
+    return mark_cases(df, get_ipc_rule_index(env, "court_ipc_green"), 'green')
+
+def mark_red(env, df):
+    return mark_cases(df, get_ipc_rule_index(env, "court_ipc_red"), 'red')
+
 def json_response_builder(args):
     
     emp_id, idx, name, full_address, state, district, case_result, case_status_code, court_names = args
@@ -279,42 +869,15 @@ def json_response_builder(args):
     if court_names != []:
         response["jurisdiction"]["court_name"] = court_names
     
-    return json.dumps(response)
-
-def write_final_response(args):
-
-    emp_id, idx, initiated_on, completed_on, case_result, case_status_code, response, report_table = args
-    metadata = MetaData()
-    result_table = Table(report_table, metadata, 
-                            Column('idx', String, primary_key=True),
-                            Column('emp_id', String),
-                            Column('initiated_on', DateTime),
-                            Column('completed_on', DateTime),
-                            Column('case_status', String),
-                            Column('status_code', Integer),
-                            Column('report', JSON)
-                            )
-    query_response = result_table.insert().values(
-                                        idx=idx, 
-                                        emp_id=emp_id, 
-                                        initiated_on=initiated_on,
-                                        completed_on=completed_on,
-                                        case_status=case_result, 
-                                        status_code=case_status_code, 
-                                        report=response)
-    return query_response
-
-def call_notify_api(env, verify_id):
-    # Set the URL and headers for notify api
-    url = env['notify_url']
-    headers = {'Content-Type': 'application/json',
-            'Authorization': env['notify_token']}
-    data = {"ref_id": str(verify_id)}
-    data = json.dumps(data)
-    # Send the curl request to notify api
-    try:
-        response = requests.post(url, headers=headers, data=data)
-        return response.status_code
-    except Exception as e:
-        print(f"Failed to send request to notify api, {e}")
-        return 0
\ No newline at end of file
+    return response
+
+def build_report_row(args):
+    emp_id, idx, initiated_on, completed_on, case_result, case_status_code, response = args
+    # asyncpg only binds datetime objects to timestamp columns
+    return dict(idx=idx, 
+                emp_id=emp_id, 
+                initiated_on=pd.Timestamp(initiated_on).to_pydatetime(),
+                completed_on=pd.Timestamp(completed_on).to_pydatetime(),
+                case_status=case_result, 
+                status_code=case_status_code, 
+                report=response)